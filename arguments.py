@@ -98,6 +98,9 @@ def get_args():
     assert not None in [args.log_dir, args.data_dir, args.ckpt_dir, args.name]
 
     args.log_dir = os.path.join(args.log_dir, 'in-progress_'+datetime.now().strftime('%m%d%H%M%S_')+args.name)
+    # the processes of a torchrun launch do not share their log directory
+    if int(os.environ.get('RANK', 0)) > 0:
+        args.log_dir += f"_rank{os.environ['RANK']}"
 
     os.makedirs(args.log_dir, exist_ok=False)
     print(f'creating file {args.log_dir}')
@@ -112,6 +115,7 @@ def get_args():
         'image_size': args.dataset.image_size,
         'cl_default': args.cl_default,
         'scale': 0.2,
+        'gpu': getattr(args.dataset, 'gpu_aug', False),
     }
     vars(args)['dataset_kwargs'] = {
         # 'name':args.model.name,
@@ -128,6 +132,8 @@ def get_args():
         'drop_last': True,
         'pin_memory': True,
         'num_workers': args.dataset.num_workers,
+        'persistent_workers': getattr(args.dataset, 'persistent_workers', True),
+        'prefetch_factor': getattr(args.dataset, 'prefetch_factor', 2),
     }
 
     return args
@@ -1,10 +1,15 @@
 from .simsiam_aug import SimSiamTransform
 from .eval_aug import Transform_single
+from .gpu_aug import ToUint8Tensor, GPUSimSiamTransform
 
 
 def get_aug(name='simsiam', image_size=224, train=True, train_classifier=None, **aug_kwargs):
     if train==True:
-        augmentation = SimSiamTransform(image_size, **aug_kwargs)
+        if aug_kwargs.get('gpu'):
+            # the views are made by get_gpu_aug once the batch is on the device
+            augmentation = ToUint8Tensor()
+        else:
+            augmentation = SimSiamTransform(image_size, **aug_kwargs)
     elif train==False:
         if train_classifier is None:
             raise Exception
@@ -15,6 +20,14 @@ def get_aug(name='simsiam', image_size=224, train=True, train_classifier=None, *
     return augmentation
 
 
+def get_gpu_aug(name='simsiam', image_size=224, gpu=False, **aug_kwargs):
+    """
+    The batched augmentation of training batches on the device, None when
+    augmentations run in the DataLoader workers.
+    """
+    return GPUSimSiamTransform(image_size, **aug_kwargs) if gpu else None
+
+
 
 
 
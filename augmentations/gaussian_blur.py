@@ -1,6 +1,6 @@
 import torch
 from torch import Tensor
-from torchvision.transforms.functional import to_pil_image, to_tensor
+from torchvision.transforms.functional import to_pil_image, to_tensor, pil_to_tensor
 from torch.nn.functional import conv2d, pad as torch_pad
 from typing import Any, List, Sequence, Optional
 import numbers
@@ -8,6 +8,12 @@ import numpy as np
 import torch
 from PIL import Image
 from typing import Tuple
+from functools import lru_cache
+
+# sigma is rounded to a multiple of SIGMA_STEP (at most MAX_SIGMA_STEPS of them)
+# so that the 1D kernels are computed once per kernel size, device and dtype
+SIGMA_STEP = 0.01
+MAX_SIGMA_STEPS = 1000
 
 class GaussianBlur(torch.nn.Module):
     """Blurs image with randomly chosen Gaussian blur.
@@ -100,6 +106,36 @@ def _get_gaussian_kernel1d(kernel_size: int, sigma: float) -> Tensor:
 
     return kernel1d
 
+@lru_cache(maxsize=None)
+def _get_gaussian_kernel_bank(kernel_size: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+    """[MAX_SIGMA_STEPS + 1, kernel_size] 1D kernels, row q for sigma = q * SIGMA_STEP (row 0 unused)."""
+    sigma = torch.arange(MAX_SIGMA_STEPS + 1, dtype=torch.float64).clamp(min=1) * SIGMA_STEP
+    ksize_half = (kernel_size - 1) * 0.5
+    x = torch.linspace(-ksize_half, ksize_half, steps=kernel_size, dtype=torch.float64)
+    pdf = torch.exp(-0.5 * (x[None, :] / sigma[:, None]).pow(2))
+    return (pdf / pdf.sum(dim=1, keepdim=True)).to(device, dtype=dtype)
+
+def _sigma_steps(sigma: Tensor) -> Tensor:
+    return (sigma / SIGMA_STEP).round().clamp(1, MAX_SIGMA_STEPS).long()
+
+def _get_gaussian_kernels1d(kernel_size: int, sigma: Tensor, dtype: torch.dtype, device: torch.device) -> Tensor:
+    """Cached 1D kernels of the (quantized) sigmas, [len(sigma), kernel_size]."""
+    bank = _get_gaussian_kernel_bank(kernel_size, torch.device(device), dtype)
+    return bank[_sigma_steps(sigma.to(bank.device))]
+
+@lru_cache(maxsize=None)
+def _get_cached_gaussian_kernel1d(kernel_size: int, sigma_steps: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+    """Cached [1, kernel_size] kernel of sigma = sigma_steps * SIGMA_STEP, for single images."""
+    return _get_gaussian_kernel_bank(kernel_size, device, dtype)[sigma_steps:sigma_steps + 1]
+
+def _separable_conv(img: Tensor, kernel_x: Tensor, kernel_y: Tensor) -> Tensor:
+    """Reflect-pads [1, G, H, W] img and convolves each of its G channels with its own [G, kx] and [G, ky] kernels."""
+    groups = img.shape[1]
+    padding = [kernel_x.shape[1] // 2, kernel_x.shape[1] // 2, kernel_y.shape[1] // 2, kernel_y.shape[1] // 2]
+    img = torch_pad(img, padding, mode="reflect")
+    img = conv2d(img, kernel_x[:, None, None, :], groups=groups)
+    return conv2d(img, kernel_y[:, None, :, None], groups=groups)
+
 def _cast_squeeze_in(img: Tensor, req_dtype: torch.dtype) -> Tuple[Tensor, bool, bool, torch.dtype]:
     need_squeeze = False
     # make image NCHW
@@ -149,15 +185,17 @@ def _gaussian_blur(img: Tensor, kernel_size: List[int], sigma: List[float]) -> T
         raise TypeError('img should be Tensor Image. Got {}'.format(type(img)))
 
     dtype = img.dtype if torch.is_floating_point(img) else torch.float32
-    kernel = _get_gaussian_kernel2d(kernel_size, sigma, dtype=dtype, device=img.device)
-    kernel = kernel.expand(img.shape[-3], 1, kernel.shape[0], kernel.shape[1])
+    steps = [min(max(round(s / SIGMA_STEP), 1), MAX_SIGMA_STEPS) for s in sigma]
+    kernel_x = _get_cached_gaussian_kernel1d(kernel_size[0], steps[0], img.device, dtype)
+    kernel_y = _get_cached_gaussian_kernel1d(kernel_size[1], steps[1], img.device, dtype)
 
-    img, need_cast, need_squeeze, out_dtype = _cast_squeeze_in(img, kernel.dtype)
+    img, need_cast, need_squeeze, out_dtype = _cast_squeeze_in(img, dtype)
 
-    # padding = (left, right, top, bottom)
-    padding = [kernel_size[0] // 2, kernel_size[0] // 2, kernel_size[1] // 2, kernel_size[1] // 2]
-    img = torch_pad(img, padding, mode="reflect")
-    img = conv2d(img, kernel, groups=img.shape[-3])
+    # the separable convolution runs over the batch and channels folded together
+    shape = img.shape
+    img = img.reshape(1, -1, shape[-2], shape[-1])
+    img = _separable_conv(img, kernel_x.expand(img.shape[1], -1), kernel_y.expand(img.shape[1], -1))
+    img = img.reshape(shape)
 
     img = _cast_squeeze_out(img, need_cast, need_squeeze, out_dtype)
     return img
@@ -213,7 +251,7 @@ def gaussian_blur(img: Tensor, kernel_size: List[int], sigma: Optional[List[floa
         if not _is_pil_image(img):
             raise TypeError('img should be PIL Image or Tensor. Got {}'.format(type(img)))
 
-        t_img = to_tensor(img)
+        t_img = pil_to_tensor(img)
 
     output = _gaussian_blur(t_img, kernel_size, sigma)
 
@@ -224,5 +262,24 @@ def gaussian_blur(img: Tensor, kernel_size: List[int], sigma: Optional[List[floa
 
 
 
+def gaussian_blur_batch(img: Tensor, kernel_size: int, sigma: Tensor) -> Tensor:
+    """Blurs every image of a [N, C, H, W] batch with its own sigma, as two
+    separable 1D convolutions over reflect-padded images. The kernels come
+    from the cache of _get_gaussian_kernel_bank.
+
+    Args:
+        img (Tensor): float images
+        kernel_size (int): odd size of the square kernel
+        sigma (Tensor): [N] standard deviations
+
+    Returns:
+        Tensor: the blurred images
+    """
+    n, c, h, w = img.shape
+    kernel1d = _get_gaussian_kernels1d(kernel_size, sigma, dtype=img.dtype, device=img.device).repeat_interleave(c, dim=0)
+    img = _separable_conv(img.reshape(1, n * c, h, w), kernel1d, kernel1d)
+    return img.reshape(n, c, h, w)
+
+
 # if __name__ == "__main__":
 #     gaussian_blur = GaussianBlur(kernel_size=23)
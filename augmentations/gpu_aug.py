@@ -0,0 +1,186 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .simsiam_aug import imagenet_mean_std
+from .gaussian_blur import gaussian_blur_batch
+
+
+class ToUint8Tensor():
+    """
+    Worker side of the GPU augmentation: the image as a uint8 CHW tensor.
+    """
+    def __call__(self, x):
+        x = torch.from_numpy(np.array(x))
+        if x.ndim == 2:
+            x = x.unsqueeze(-1)
+        return x.permute(2, 0, 1).contiguous()
+
+
+def rgb_to_grayscale(img):
+    r, g, b = img.unbind(-3)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(-3)
+
+
+def rgb_to_hsv(img):
+    r, g, b = img.unbind(-3)
+    maxc = img.max(-3).values
+    minc = img.min(-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def hsv_to_rgb(img):
+    h, s, v = img.unbind(-3)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int32) % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    mask = i.unsqueeze(-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(img.dtype), a4)
+
+
+def adjust_brightness(img, factor):
+    return (img * factor).clamp(0, 1)
+
+
+def adjust_contrast(img, factor):
+    mean = rgb_to_grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+    return (factor * img + (1 - factor) * mean).clamp(0, 1)
+
+
+def adjust_saturation(img, factor):
+    return (factor * img + (1 - factor) * rgb_to_grayscale(img)).clamp(0, 1)
+
+
+def adjust_hue(img, factor):
+    h, s, v = rgb_to_hsv(img).unbind(-3)
+    h = torch.remainder(h + factor.view(-1, 1, 1), 1.0)
+    return hsv_to_rgb(torch.stack((h, s, v), dim=-3))
+
+
+def color_jitter(img, brightness, contrast, saturation, hue):
+    """
+    Batched ColorJitter: every sample draws its own factors and its own order
+    of the four adjustments, as T.ColorJitter does per image.
+    """
+    n = len(img)
+    factors = [torch.empty(n, 1, 1, 1, device=img.device).uniform_(1 - brightness, 1 + brightness),
+               torch.empty(n, 1, 1, 1, device=img.device).uniform_(1 - contrast, 1 + contrast),
+               torch.empty(n, 1, 1, 1, device=img.device).uniform_(1 - saturation, 1 + saturation),
+               torch.empty(n, device=img.device).uniform_(-hue, hue)]
+    adjustments = [adjust_brightness, adjust_contrast, adjust_saturation, adjust_hue]
+    order = torch.rand(n, 4, device=img.device).argsort(dim=1)
+    for position in range(4):
+        for op, (adjust, factor) in enumerate(zip(adjustments, factors)):
+            idx = order[:, position] == op
+            if idx.any():
+                img[idx] = adjust(img[idx], factor[idx])
+    return img
+
+
+class GPUSimSiamTransform():
+    """
+    SimSiamTransform over a batch of uint8 images already on the device. The
+    two views are augmented as one batch, every sample drawing its own crop,
+    flip, jitter, grayscale and blur parameters. Resizing is bilinear without
+    antialiasing, so views match the PIL pipeline in distribution, not bit-wise.
+    """
+    def __init__(self, image_size, mean_std=imagenet_mean_std, **aug_kwargs):
+        image_size = 224 if image_size is None else image_size # by default simsiam use image size 224
+        self.image_size = image_size
+        self.p_blur = 0.5 if image_size > 32 else 0 # exclude cifar
+        self.kernel_size = image_size//20*2+1
+        self.cl_default = aug_kwargs['cl_default']
+        self.scale = (aug_kwargs['scale'], 1.0)
+        self.mean, self.std = mean_std
+
+    def crop_boxes(self, n, height, width, device):
+        """
+        Per-sample (top, left, height, width) of the crops, drawn as T.RandomResizedCrop
+        (ten attempts, then a center crop) or as T.RandomCrop with padding=4 if cl_default.
+        """
+        if self.cl_default:
+            size = torch.full((n,), float(self.image_size), device=device)
+            top = torch.randint(0, height + 8 - self.image_size + 1, (n,), device=device).float() - 4
+            left = torch.randint(0, width + 8 - self.image_size + 1, (n,), device=device).float() - 4
+            return top, left, size, size
+
+        area = height * width
+        log_ratio = (math.log(3 / 4), math.log(4 / 3))
+        target_area = area * torch.empty(n, 10, device=device).uniform_(*self.scale)
+        aspect_ratio = torch.exp(torch.empty(n, 10, device=device).uniform_(*log_ratio))
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = valid.float().argmax(dim=1, keepdim=True)
+        w, h = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1)
+        top = (torch.rand(n, device=device) * (height - h + 1)).floor()
+        left = (torch.rand(n, device=device) * (width - w + 1)).floor()
+
+        fallback = ~valid.any(dim=1)
+        if fallback.any():
+            in_ratio = width / height
+            if in_ratio < 3 / 4:
+                w_f, h_f = width, round(width / (3 / 4))
+            elif in_ratio > 4 / 3:
+                w_f, h_f = round(height * (4 / 3)), height
+            else:
+                w_f, h_f = width, height
+            h[fallback], w[fallback] = h_f, w_f
+            top[fallback], left[fallback] = (height - h_f) // 2, (width - w_f) // 2
+        return top, left, h, w
+
+    def crop_flip(self, img):
+        """
+        Crops, resizes to image_size and horizontally flips (p=0.5) every sample
+        with a single grid_sample.
+        """
+        n, _, height, width = img.shape
+        top, left, h, w = self.crop_boxes(n, height, width, img.device)
+        flip = torch.where(torch.rand(n, device=img.device) < 0.5, -1.0, 1.0)
+        theta = torch.zeros(n, 2, 3, device=img.device)
+        theta[:, 0, 0] = w / width * flip
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = F.affine_grid(theta, (n, img.shape[1], self.image_size, self.image_size), align_corners=False)
+        return F.grid_sample(img, grid, mode='bilinear', padding_mode='zeros' if self.cl_default else 'border',
+                             align_corners=False)
+
+    def transform(self, img):
+        n = len(img)
+        img = self.crop_flip(img)
+        jitter = torch.rand(n, device=img.device) < 0.8
+        img[jitter] = color_jitter(img[jitter], 0.4, 0.4, 0.4, 0.1)
+        gray = torch.rand(n, device=img.device) < 0.2
+        img[gray] = rgb_to_grayscale(img[gray]).expand(-1, 3, -1, -1)
+        if self.p_blur:
+            blur = torch.rand(n, device=img.device) < self.p_blur
+            sigma = torch.empty(int(blur.sum()), device=img.device).uniform_(0.1, 2.0)
+            img[blur] = gaussian_blur_batch(img[blur], self.kernel_size, sigma)
+        mean = torch.tensor(self.mean, device=img.device).view(1, -1, 1, 1)
+        std = torch.tensor(self.std, device=img.device).view(1, -1, 1, 1)
+        return (img - mean) / std
+
+    def __call__(self, x):
+        not_aug_x = x.float() / 255
+        x1, x2 = self.transform(torch.cat([not_aug_x, not_aug_x])).chunk(2)
+        return x1, x2, not_aug_x
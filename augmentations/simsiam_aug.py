@@ -1,10 +1,7 @@
 import torchvision.transforms as T
 from PIL import Image
-try:
-    from torchvision.transforms import GaussianBlur
-except ImportError:
-    from .gaussian_blur import GaussianBlur
-    T.GaussianBlur = GaussianBlur
+# separable and with cached kernels, unlike torchvision's
+from .gaussian_blur import GaussianBlur
     
 # imagenet_mean_std = [[0.485, 0.456, 0.406],[0.229, 0.224, 0.225]]
 imagenet_mean_std = [[0.4914, 0.4822, 0.4465],[0.2470, 0.2435, 0.2615]]
@@ -23,7 +20,7 @@ class SimSiamTransform():
             T.RandomHorizontalFlip(),
             T.RandomApply([T.ColorJitter(0.4,0.4,0.4,0.1)], p=0.8),
             T.RandomGrayscale(p=0.2),
-            T.RandomApply([T.GaussianBlur(kernel_size=image_size//20*2+1, sigma=(0.1, 2.0))], p=p_blur),
+            T.RandomApply([GaussianBlur(kernel_size=image_size//20*2+1, sigma=(0.1, 2.0))], p=p_blur),
             T.ToTensor(),
             T.Normalize(*mean_std)
         ])
@@ -10,7 +10,7 @@ from datasets.seq_cifar10 import SequentialCIFAR10
 from datasets.seq_cifar100 import SequentialCIFAR100
 from datasets.seq_tinyimagenet import SequentialTinyImagenet
 from datasets.seq_svhn import SequentialSVHN
-from datasets.utils.continual_dataset import ContinualDataset
+from datasets.utils.continual_dataset import ContinualDataset, export_splits
 from argparse import Namespace
 import torchvision
 
@@ -35,6 +35,17 @@ def get_dataset(args: Namespace) -> ContinualDataset:
     return NAMES[args.dataset_kwargs['dataset']](args)
 
 
+def load_shared_splits(args: Namespace) -> dict:
+    """
+    Loads the splits of the continual dataset in this process, so that they
+    can be placed once in shared memory and used by several trials.
+    :param args: the arguments which contains the hyperparameters
+    :return: the splits, see export_splits
+    """
+    get_dataset(args).get_data_loaders(args)
+    return export_splits()
+
+
 def get_gcl_dataset(args: Namespace):
     """
     Creates and returns a GCL dataset.
@@ -9,8 +9,9 @@ import torch.nn.functional as F
 from datasets.seq_tinyimagenet import base_path
 from PIL import Image
 from datasets.utils.validation import get_train_val
-from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders
-from datasets.utils.continual_dataset import get_previous_train_loader
+from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders, get_task_loader
+from datasets.utils.continual_dataset import get_previous_train_loader, unique_tmp_path
+from utils.distributed import is_main_process, barrier
 from torch.utils.data import DataLoader
 import numpy as np
 from typing import Tuple
@@ -18,10 +19,102 @@ from datasets.transforms.denormalization import DeNormalize
 import torch
 from augmentations import get_aug
 from PIL import Image
-from wilds import get_dataset
-from wilds.common.data_loaders import get_train_loader, get_eval_loader
-from copy import deepcopy
+from torch.utils.data import Dataset
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+import argparse
 import socket
+import os
+
+
+# columns of the packed metadata arrays
+METADATA_COLUMNS = ['y', 'region', 'year', 'index']
+
+
+def fmow_root() -> str:
+    return f"/{socket.gethostname().split('.')[0]}/scr0/msun415/"
+
+
+class ResizedFMoW(Dataset):
+    """
+    WILDS FMoW images at indices, decoded and resized to image_size x image_size.
+    """
+    def __init__(self, dataset, indices: np.ndarray, image_size: int) -> None:
+        self.dataset = dataset
+        self.indices = indices
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        img = self.dataset.get_input(self.indices[index]).convert('RGB')
+        img = img.resize((self.image_size, self.image_size), Image.BICUBIC)
+        return torch.from_numpy(np.array(img))
+
+
+def pack_fmow(root: str, path: str, image_size: int, splits=('train', 'id_val'), num_workers: int=8) -> None:
+    """
+    Resizes the WILDS FMoW splits once to image_size and writes, for each split,
+    the images as a single uint8 array path/x_<split>.npy partitioned by region
+    then year (contiguous samples, so that a region or year task reads
+    sequentially) and their metadata (METADATA_COLUMNS) as path/metadata_<split>.npy.
+    :param root: WILDS root directory
+    :param path: output directory
+    :param image_size: side of the packed images
+    :param splits: WILDS splits to pack
+    :param num_workers: processes decoding the images
+    """
+    from wilds import get_dataset
+    dataset = get_dataset(dataset="fmow", root_dir=root, download=False)
+    fields = dataset.metadata_fields
+    os.makedirs(path, exist_ok=True)
+    for split in splits:
+        # packed by a concurrent process in the meantime
+        if os.path.exists(os.path.join(path, f'metadata_{split}.npy')):
+            continue
+        indices = dataset.get_subset(split).indices
+        region = dataset.metadata_array[indices, fields.index('region')].numpy()
+        year = dataset.metadata_array[indices, fields.index('year')].numpy()
+        order = np.lexsort((indices, year, region))
+        indices, region, year = indices[order], region[order], year[order]
+        metadata = np.stack([dataset.y_array[indices].numpy(), region, year, indices], axis=1).astype(np.int64)
+
+        tmp_path = unique_tmp_path(os.path.join(path, f'x_{split}.npy'))
+        data = open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(indices), image_size, image_size, 3))
+        loader = DataLoader(ResizedFMoW(dataset, indices, image_size), batch_size=256, num_workers=num_workers)
+        start = 0
+        for images in tqdm(loader, desc=f'Packing {split}'):
+            data[start:start + len(images)] = images.numpy()
+            start += len(images)
+        data.flush()
+        del data
+        os.replace(tmp_path, os.path.join(path, f'x_{split}.npy'))
+        # written last, it marks the split as packed
+        tmp_path = unique_tmp_path(os.path.join(path, f'metadata_{split}.npy'))
+        np.save(tmp_path, metadata)
+        os.replace(tmp_path, os.path.join(path, f'metadata_{split}.npy'))
+
+
+class PackedFMoW(Dataset):
+    """
+    A FMoW split packed by pack_fmow: the images are memory-mapped read-only,
+    so their pages are shared by every dataset and worker through the page cache.
+    """
+    def __init__(self, path: str, split: str, transform: transforms=None) -> None:
+        self.data = np.load(os.path.join(path, f'x_{split}.npy'), mmap_mode='r')
+        self.metadata = np.load(os.path.join(path, f'metadata_{split}.npy'))
+        self.targets = self.metadata[:, METADATA_COLUMNS.index('y')]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        img = Image.fromarray(self.data[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index], self.metadata[index]
 
 
 class FMOW(ContinualDataset):
@@ -34,29 +127,57 @@ class FMOW(ContinualDataset):
     # REGION_ORDER = [5,2,4,0,3,1]
     YEAR_ORDER = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
 
+    # region, year or region_year (one task per region and year, regions first)
     TASK_DEFINITION = "region"
     N_TASKS = 6
 
     def __init__(self, args):
-        dataset = get_dataset(dataset="fmow", root_dir=f"/{socket.gethostname().split('.')[0]}/scr0/msun415/", download=False)
+        root = getattr(args.dataset, 'root', None) or fmow_root()
+        self.TASK_DEFINITION = getattr(args.dataset, 'task_definition', self.TASK_DEFINITION)
+        path = os.path.join(root, f'fmow_packed_{args.dataset.image_size}')
+        # packed once per node by the main process of a distributed run; other
+        # runs packing at the same time (Ray trials) write their own temporary files
+        if is_main_process() and not os.path.exists(os.path.join(path, 'metadata_id_val.npy')):
+            print(f'Packing FMoW at {args.dataset.image_size}x{args.dataset.image_size} into {path}')
+            pack_fmow(root, path, args.dataset.image_size)
+        barrier()
         transform = get_aug(train=True, **args.aug_kwargs)
         test_transform = get_aug(train=False, train_classifier=False, **args.aug_kwargs)
-        self.train_data = dataset.get_subset("train", transform=transform)
-        self.memory_data = dataset.get_subset("train", transform=test_transform)
-        self.test_data = dataset.get_subset("id_val", transform=test_transform)
-
-        metadataset = dataset.metadata.iloc[np.argwhere((dataset.metadata['split'] != 'seq').values).flatten(), :]
-
-        self.train_dataset = metadataset.iloc[self.train_data.indices]
-        self.memory_dataset = metadataset.iloc[self.memory_data.indices]
-        self.test_dataset = metadataset.iloc[self.test_data.indices]       
-
-        self.train_data.targets = self.train_dataset.y.values
-        self.memory_data.targets = self.memory_dataset.y.values
-        self.test_data.targets = self.test_dataset.y.values
+        self.train_data = PackedFMoW(path, 'train', transform)
+        self.memory_data = PackedFMoW(path, 'train', test_transform)
+        self.test_data = PackedFMoW(path, 'id_val', test_transform)
 
+        self.task_index = self.build_task_index()
+        self.N_TASKS = len(self.task_index)
         super().__init__(args)
 
+    def build_task_index(self) -> list:
+        """
+        Sorted train and test indices of every task, in task order. Tasks
+        without training or test samples (region_year only) are skipped.
+        """
+        assert self.TASK_DEFINITION in ('region', 'year', 'region_year'), f"unknown task definition {self.TASK_DEFINITION}"
+        if self.TASK_DEFINITION == 'region':
+            tasks = [{'region': region} for region in self.REGION_ORDER]
+        elif self.TASK_DEFINITION == 'year':
+            tasks = [{'year': year} for year in self.YEAR_ORDER]
+        else:
+            tasks = [{'region': region, 'year': year} for region in self.REGION_ORDER for year in self.YEAR_ORDER]
+
+        task_index = []
+        for task in tasks:
+            train_indices, test_indices = [np.flatnonzero(np.all([data.metadata[:, METADATA_COLUMNS.index(column)] == value
+                                                                  for column, value in task.items()], axis=0))
+                                           for data in (self.train_data, self.test_data)]
+            if len(train_indices) and len(test_indices):
+                task_index.append((train_indices, test_indices))
+            else:
+                print(f'Skipping the empty FMoW task {task} ({len(train_indices)} train, {len(test_indices)} test samples)')
+        # only region and year pairs may be missing from a split
+        assert self.TASK_DEFINITION == 'region_year' or len(task_index) == len(tasks), \
+            f"empty {self.TASK_DEFINITION} task in FMoW"
+        return task_index
+
     def get_transform(self, args):
         cifar_norm = [[0.4914, 0.4822, 0.4465], [0.2470, 0.2435, 0.2615]]
         if args.cl_default:
@@ -81,32 +202,12 @@ class FMOW(ContinualDataset):
 
    
     def get_data_loaders(self, args, divide_tasks=True):
-        task_train_data = deepcopy(self.train_data)
-        mask = self.train_dataset[self.TASK_DEFINITION] == (self.REGION_ORDER if self.TASK_DEFINITION == "region" else self.YEAR_ORDER)[self.i] if divide_tasks else np.full((len(self.train_dataset),), True)
-        indices = self.train_dataset[mask].index.values
-        # if args.debug: indices = np.random.permutation(indices)[:args.train.batch_size]
-        task_train_data.indices = indices                
-        task_train_data.targets = self.train_dataset[mask].y.values
-
-        task_memory_data = deepcopy(self.memory_data)
-        mask = self.memory_dataset[self.TASK_DEFINITION] == (self.REGION_ORDER if self.TASK_DEFINITION == "region" else self.YEAR_ORDER)[self.i]
-        indices = self.memory_dataset[mask].index.values
-        # if args.debug: indices = np.random.permutation(indices)[:args.train.batch_size]
-        task_memory_data.indices = indices                
-        task_memory_data.targets = self.memory_dataset[mask].y.values
-
-        task_test_data = deepcopy(self.test_data)
-        mask = self.test_dataset[self.TASK_DEFINITION] == (self.REGION_ORDER if self.TASK_DEFINITION == "region" else self.YEAR_ORDER)[self.i]
-        indices = self.test_dataset[mask].index.values
-        # if args.debug: indices = np.random.permutation(indices)[:args.train.batch_size]
-        task_test_data.indices = indices                
-        task_test_data.targets = self.test_dataset[mask].y.values
-
-        num_workers = 0 if args.debug else 0
-
-        train_loader = get_train_loader("standard", task_train_data, batch_size=self.args.train.batch_size, num_workers=num_workers)
-        memory_loader = get_eval_loader("standard", task_memory_data, batch_size=self.args.train.batch_size//8, num_workers=num_workers)
-        test_loader = get_eval_loader("standard", task_test_data, batch_size=self.args.train.batch_size//8, num_workers=num_workers)
+        memory_indices, test_indices = self.task_index[self.i]
+        train_indices = memory_indices if divide_tasks else np.arange(len(self.train_data))
+
+        train_loader = get_task_loader(self, self.train_data, train_indices, train=True)
+        memory_loader = get_task_loader(self, self.memory_data, memory_indices, train=False, batch_size=self.args.train.batch_size//8)
+        test_loader = get_task_loader(self, self.test_data, test_indices, train=False, batch_size=self.args.train.batch_size//8)
 
         self.test_loaders.append(test_loader)
         self.train_loaders.append(train_loader)
@@ -114,4 +215,12 @@ class FMOW(ContinualDataset):
         self.train_loader = train_loader
         self.i += 1
         return train_loader, memory_loader, test_loader
-    
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Packs WILDS FMoW for the fmow dataset')
+    parser.add_argument('--root', default=fmow_root())
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+    pack_fmow(args.root, os.path.join(args.root, f'fmow_packed_{args.image_size}'), args.image_size, num_workers=args.num_workers)
@@ -1,14 +1,31 @@
+import numpy as np
 import torch
+from PIL import Image
 
 class RandomDataset(torch.utils.data.Dataset):
-    def __init__(self, root=None, train=True, transform=None, target_transform=None):
+    """
+    Synthetic dataset of random RGB images (PIL, like the torchvision datasets),
+    to run loaders and augmentations offline. The images come from a small
+    pool built once, so reading a sample costs as little as a decoded array.
+    """
+    def __init__(self, root=None, train=True, transform=None, target_transform=None,
+                 image_size=224, size=1000, num_classes=10, pool_size=64, seed=0):
         self.transform = transform
         self.target_transform = target_transform
 
-        self.size = 1000
+        self.size = size
+        rng = np.random.RandomState(seed)
+        self.data = rng.randint(0, 256, (pool_size, image_size, image_size, 3), dtype=np.uint8)
+        self.targets = rng.randint(0, num_classes, size)
+
     def __getitem__(self, idx):
         if idx < self.size:
-            return [torch.randn((3, 224, 224)), torch.randn((3, 224, 224))], [0,0,0]
+            img, target = Image.fromarray(self.data[idx % len(self.data)]), self.targets[idx]
+            if self.transform is not None:
+                img = self.transform(img)
+            if self.target_transform is not None:
+                target = self.target_transform(target)
+            return img, target
         else:
             raise Exception
 
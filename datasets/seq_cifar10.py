@@ -9,7 +9,7 @@ import torch.nn.functional as F
 from datasets.seq_tinyimagenet import base_path
 from PIL import Image
 from datasets.utils.validation import get_train_val
-from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders
+from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders, load_split
 from datasets.utils.continual_dataset import get_previous_train_loader
 from typing import Tuple
 from datasets.transforms.denormalization import DeNormalize
@@ -26,21 +26,20 @@ class SequentialCIFAR10(ContinualDataset):
     N_TASKS = 5
    
     def get_data_loaders(self, args, divide_tasks=True):
-        transform = get_aug(train=True, **args.aug_kwargs)
-        test_transform = get_aug(train=False, train_classifier=False, **args.aug_kwargs)
+        if self.splits is None:
+            transform = get_aug(train=True, **args.aug_kwargs)
+            test_transform = get_aug(train=False, train_classifier=False, **args.aug_kwargs)
 
-        train_dataset = CIFAR10(base_path() + 'CIFAR10', train=True,
-                                  download=True, transform=transform)
-        
-        memory_dataset = CIFAR10(base_path() + 'CIFAR10', train=True,
-                                  download=True, transform=test_transform)
-        if self.args.validation:
-            train_dataset, test_dataset = get_train_val(train_dataset, test_transform, self.NAME)
-            memory_dataset, _ = get_train_val(memory_dataset, test_transform, self.NAME)
-        else:
-            test_dataset = CIFAR10(base_path() + 'CIFAR10',train=False,
-                                   download=True, transform=test_transform)
-        
+            train_dataset = load_split(CIFAR10, base_path() + 'CIFAR10', True, transform)
+            memory_dataset = load_split(CIFAR10, base_path() + 'CIFAR10', True, test_transform)
+            if self.args.validation:
+                train_dataset, test_dataset = get_train_val(train_dataset, test_transform, self.NAME)
+                memory_dataset, _ = get_train_val(memory_dataset, test_transform, self.NAME)
+            else:
+                test_dataset = load_split(CIFAR10, base_path() + 'CIFAR10', False, test_transform)
+            self.splits = train_dataset, memory_dataset, test_dataset
+
+        train_dataset, memory_dataset, test_dataset = self.splits
         train, memory, test = store_masked_loaders(train_dataset, test_dataset, memory_dataset, self)
         return train, memory, test
     
@@ -70,8 +69,7 @@ class SequentialCIFAR10(ContinualDataset):
         transform = transforms.Compose([transforms.ToTensor(), 
                 transforms.Normalize(*cifar_norm)])
 
-        train_dataset = CIFAR10(base_path() + 'CIFAR10', train=True,
-                                  download=True, transform=transform)
+        train_dataset = load_split(CIFAR10, base_path() + 'CIFAR10', True, transform)
         train_loader = get_previous_train_loader(train_dataset, batch_size, self)
 
         return train_loader
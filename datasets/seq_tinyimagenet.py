@@ -11,12 +11,43 @@ from utils.conf import base_path
 from PIL import Image
 import os
 from datasets.utils.validation import get_train_val
-from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders
+from datasets.utils.continual_dataset import ContinualDataset, store_masked_loaders, load_split, unique_tmp_path
+from utils.distributed import is_main_process, barrier
 from datasets.utils.continual_dataset import get_previous_train_loader
 from datasets.transforms.denormalization import DeNormalize
 from augmentations import get_aug
 
 
+def convert_shards(root: str, split: str, num_shards: int=20) -> None:
+    """
+    Converts the float shards processed/x_<split>_XX.npy into a single uint8
+    array processed/x_<split>.npy (and the labels into processed/y_<split>.npy),
+    one shard at a time, so that the dataset can be memory-mapped.
+    :param root: root directory of the dataset
+    :param split: 'train' or 'val'
+    :param num_shards: number of shards
+    """
+    shards = [os.path.join(root, 'processed/x_%s_%02d.npy' % (split, num+1)) for num in range(num_shards)]
+    shapes = [np.load(shard, mmap_mode='r').shape for shard in shards]
+    tmp_path = unique_tmp_path(os.path.join(root, 'processed/x_%s.npy' % split))
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                     shape=(sum(s[0] for s in shapes),) + shapes[0][1:])
+    start = 0
+    for shard, shape in zip(shards, shapes):
+        # same rounding as the former per-sample np.uint8(255 * img)
+        data[start:start + shape[0]] = (255 * np.load(shard)).astype(np.uint8)
+        start += shape[0]
+    data.flush()
+    del data
+    targets = np.concatenate([np.load(os.path.join(root, 'processed/y_%s_%02d.npy' % (split, num+1)))
+                              for num in range(num_shards)])
+    # the labels first: the images mark the split as converted
+    y_tmp_path = unique_tmp_path(os.path.join(root, 'processed/y_%s.npy' % split))
+    np.save(y_tmp_path, targets)
+    os.replace(y_tmp_path, os.path.join(root, 'processed/y_%s.npy' % split))
+    os.replace(tmp_path, os.path.join(root, 'processed/x_%s.npy' % split))
+
+
 class TinyImagenet(Dataset):
     """
     Defines Tiny Imagenet as for the others pytorch datasets.
@@ -44,19 +75,15 @@ class TinyImagenet(Dataset):
                     dest_path=os.path.join(root, 'tiny-imagenet-processed.zip'),
                     unzip=True)
 
-        self.data = []
-        for num in range(20):
-            self.data.append(np.load(os.path.join(
-                root, 'processed/x_%s_%02d.npy' %
-                      ('train' if self.train else 'val', num+1))))
-        self.data = np.concatenate(np.array(self.data))
-
-        self.targets = []
-        for num in range(20):
-            self.targets.append(np.load(os.path.join(
-                root, 'processed/y_%s_%02d.npy' %
-                      ('train' if self.train else 'val', num+1))))
-        self.targets = np.concatenate(np.array(self.targets))
+        split = 'train' if self.train else 'val'
+        # converted by the main process of a distributed run, see convert_shards for concurrent runs
+        if is_main_process() and not os.path.exists(os.path.join(root, 'processed/x_%s.npy' % split)):
+            print('Converting %s shards to uint8' % split)
+            convert_shards(root, split)
+        barrier()
+        # read-only memory map: the pages are shared by every process through the page cache
+        self.data = np.load(os.path.join(root, 'processed/x_%s.npy' % split), mmap_mode='r')
+        self.targets = np.load(os.path.join(root, 'processed/y_%s.npy' % split))
 
     def __len__(self):
         return len(self.data)
@@ -66,7 +93,7 @@ class TinyImagenet(Dataset):
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(np.uint8(255 * img))
+        img = Image.fromarray(img)
         original_img = img.copy()
 
         if self.transform is not None:
@@ -94,23 +121,22 @@ class SequentialTinyImagenet(ContinualDataset):
              transforms.Normalize((0.4802, 0.4480, 0.3975),
                                   (0.2770, 0.2691, 0.2821))])
 
-    def get_data_loaders(self, args):
-        transform = get_aug(train=True, **args.aug_kwargs)
-        test_transform = get_aug(train=False, train_classifier=False, **args.aug_kwargs)
-
-        train_dataset = TinyImagenet(base_path() + 'TINYIMG',
-                                 train=True, download=True, transform=transform)
-
-        memory_dataset = TinyImagenet(base_path() + 'TINYIMG',
-                                 train=True, download=True, transform=test_transform)
-        if self.args.validation:
-            train_dataset, test_dataset = get_train_val(train_dataset,
-                                                    test_transform, self.NAME)
-            memory_dataset, _ = get_train_val(memory_dataset, test_transform, self.NAME)
-        else:
-            test_dataset = TinyImagenet(base_path() + 'TINYIMG',
-                        train=False, download=True, transform=test_transform)
+    def get_data_loaders(self, args, divide_tasks=True):
+        if self.splits is None:
+            transform = get_aug(train=True, **args.aug_kwargs)
+            test_transform = get_aug(train=False, train_classifier=False, **args.aug_kwargs)
+
+            train_dataset = load_split(TinyImagenet, base_path() + 'TINYIMG', True, transform)
+            memory_dataset = load_split(TinyImagenet, base_path() + 'TINYIMG', True, test_transform)
+            if self.args.validation:
+                train_dataset, test_dataset = get_train_val(train_dataset,
+                                                        test_transform, self.NAME)
+                memory_dataset, _ = get_train_val(memory_dataset, test_transform, self.NAME)
+            else:
+                test_dataset = load_split(TinyImagenet, base_path() + 'TINYIMG', False, test_transform)
+            self.splits = train_dataset, memory_dataset, test_dataset
 
+        train_dataset, memory_dataset, test_dataset = self.splits
         train, memory, test = store_masked_loaders(train_dataset, test_dataset, memory_dataset, self)
         return train, memory, test
 
@@ -140,8 +166,7 @@ class SequentialTinyImagenet(ContinualDataset):
         transform = transforms.Compose([transforms.ToTensor(), 
                 transforms.Normalize(*imagenet_norm)])
 
-        train_dataset = TinyImagenet(base_path() + 'TINYIMG',
-                            train=True, download=True, transform=transform)
+        train_dataset = load_split(TinyImagenet, base_path() + 'TINYIMG', True, transform)
         train_loader = get_previous_train_loader(train_dataset, batch_size, self)
 
         return train_loader
@@ -8,10 +8,15 @@ from argparse import Namespace
 from sklearn.model_selection import train_test_split
 from torch import nn as nn
 from torchvision.transforms import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset, Sampler
 from typing import Tuple
 from torchvision import datasets
 import numpy as np
+import torch
+import copy
+import math
+import uuid
+from utils.distributed import is_distributed, get_rank, get_world_size
 
 
 class ContinualDataset:
@@ -35,6 +40,11 @@ class ContinualDataset:
         self.train_loaders = []
         self.i = 0
         self.args = args
+        # (train, memory, test) datasets, built on the first get_data_loaders
+        # call and sliced into tasks on every call
+        self.splits = None
+        # DataLoaders shared by the tasks of each dataset, see get_task_loader
+        self.loader_pool = {}
 
     @abstractmethod
     def get_data_loaders(self) -> Tuple[DataLoader, DataLoader]:
@@ -96,11 +106,214 @@ class ContinualDataset:
         pass
 
 
+def unique_tmp_path(path: str) -> str:
+    """
+    Temporary path next to the .npy file path, unique to the caller: processes
+    writing the same file concurrently (torchrun ranks, Ray trials) each write
+    their own copy, then os.replace it onto path, which is atomic.
+    """
+    return f'{path[:-len(".npy")]}.{uuid.uuid4().hex}.tmp.npy'
+
+
+# splits read from disk by load_split, shared by every ContinualDataset of the process
+_SPLITS = {}
+
+
+def export_splits() -> dict:
+    """
+    Returns the splits loaded by this process, to be handed to other processes
+    (e.g. through the Ray object store) with import_splits. Memory-mapped
+    splits are left out: the page cache already shares them.
+    """
+    return {key: split for key, split in _SPLITS.items() if not isinstance(split.data, np.memmap)}
+
+
+def import_splits(splits: dict) -> None:
+    """
+    Makes load_split return the given splits instead of reading them from
+    disk. Their arrays may be read-only views of shared memory.
+    """
+    _SPLITS.update(splits)
+
+
+def load_split(dataset_cls, root: str, train: bool, transform: transforms) -> datasets:
+    """
+    Returns the train or test split of dataset_cls with the given transform.
+    The split is read from disk (and its label index built) once per process,
+    every call returns a shallow copy sharing the data and targets arrays,
+    which forked DataLoader workers share with the main process as well.
+    :param dataset_cls: torchvision-like dataset class with data and targets
+    :param root: root directory of the dataset
+    :param train: train or test split
+    :param transform: transform of the returned copy
+    :return: the split
+    """
+    key = (dataset_cls, root, train)
+    if key not in _SPLITS:
+        split = dataset_cls(root, train=train, download=True)
+        split.targets = np.asarray(split.targets)
+        get_label_index(split)
+        _SPLITS[key] = split
+    split = copy.copy(_SPLITS[key])
+    split.transform = transform
+    return split
+
+
+class LabelIndex:
+    """
+    Label -> sample indices of a dataset, so that selecting the samples of a
+    range of classes is a slice instead of a mask over all the targets.
+    """
+    def __init__(self, targets) -> None:
+        self.targets = targets
+        targets = np.asarray(targets)
+        self.order = np.argsort(targets, kind='stable')
+        self.offsets = np.searchsorted(targets[self.order], np.arange(targets.max() + 2))
+
+    def indices(self, low: int, high: int) -> np.ndarray:
+        """
+        Sorted indices of the samples whose label is in [low, high).
+        """
+        low, high = min(low, len(self.offsets) - 1), min(high, len(self.offsets) - 1)
+        return np.sort(self.order[self.offsets[low]:self.offsets[high]])
+
+
+def get_label_index(dataset: datasets) -> LabelIndex:
+    """
+    Returns the label index of dataset, building it if its targets changed.
+    """
+    index = dataset.__dict__.get('label_index')
+    if index is None or index.targets is not dataset.targets:
+        index = dataset.label_index = LabelIndex(dataset.targets)
+    return index
+
+
+class TaskSubset(Subset):
+    """
+    The samples of a task, as a view over the whole split.
+    """
+    @property
+    def targets(self) -> np.ndarray:
+        return np.asarray(self.dataset.targets)[self.indices]
+
+
+def get_loader_kwargs(args: Namespace, train: bool, persistent: bool=False) -> dict:
+    """
+    DataLoader keyword arguments from args.dataloader_kwargs: drop_last only
+    applies to training, pinned memory only when cuda is available, and
+    workers prefetch prefetch_factor batches each.
+    :param args: the arguments
+    :param train: whether the loader is a training one
+    :param persistent: whether the loader is kept across tasks (get_task_loader),
+                       whose workers are then persistent (unless persistent_workers
+                       is False); the workers of other loaders would never be shut down
+    :return: the keyword arguments
+    """
+    kwargs = dict(getattr(args, 'dataloader_kwargs', {}))
+    kwargs['drop_last'] = train and kwargs.get('drop_last', False)
+    kwargs['pin_memory'] = kwargs.get('pin_memory', False) and torch.cuda.is_available()
+    if kwargs.get('num_workers', 0) > 0:
+        kwargs['persistent_workers'] = persistent and kwargs.get('persistent_workers', True)
+        kwargs.setdefault('prefetch_factor', 2)
+    else:
+        kwargs.pop('persistent_workers', None)
+        kwargs.pop('prefetch_factor', None)
+    return kwargs
+
+
+class TaskSampler(Sampler):
+    """
+    Samples the indices of the current task, which are replaced between tasks
+    so that the DataLoader (and its workers) can be kept. With num_replicas
+    processes, each one samples its rank's shard of the same permutation
+    (drawn from seed and the number of epochs so far), padded as in
+    DistributedSampler so that all the shards have the same length.
+    """
+    def __init__(self, shuffle: bool, num_replicas: int=1, rank: int=0, seed: int=0) -> None:
+        self.indices = np.arange(0)
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        if self.num_replicas == 1:
+            indices = self.indices[torch.randperm(len(self.indices)).numpy()] if self.shuffle else self.indices
+            return iter(indices.tolist())
+        indices = self.indices
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+            self.epoch += 1
+        indices = np.resize(indices, self.num_samples(len(indices)) * self.num_replicas)
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def num_samples(self, n: int) -> int:
+        """
+        Number of samples drawn by each process out of n.
+        """
+        return math.ceil(n / self.num_replicas)
+
+    def __len__(self) -> int:
+        return self.num_samples(len(self.indices))
+
+
+class TaskLoader:
+    """
+    Loader over the samples of dataset at indices. The TaskLoaders of a
+    dataset share one DataLoader, which is pointed at their indices when
+    they are iterated: two of them must not be iterated at the same time.
+    """
+    def __init__(self, loader: DataLoader, indices: np.ndarray) -> None:
+        self.loader = loader
+        self.indices = indices
+        self.dataset = TaskSubset(loader.dataset, indices)
+        self.batch_size = loader.batch_size
+
+    def __len__(self) -> int:
+        n = self.loader.sampler.num_samples(len(self.indices))
+        if self.loader.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        self.loader.sampler.indices = self.indices
+        return iter(self.loader)
+
+
+def get_task_loader(setting: ContinualDataset, dataset: datasets, indices: np.ndarray,
+                    train: bool, batch_size: int=None) -> TaskLoader:
+    """
+    Returns a loader over the samples of dataset at indices, reusing the
+    DataLoader (and its persistent workers) of the previous tasks. In a
+    distributed run, training loaders only load the shard of the process.
+    :param setting: continual learning setting, which holds the loaders
+    :param dataset: the whole split
+    :param indices: the samples of the task
+    :param train: shuffles the samples and drops the last incomplete batch
+    :param batch_size: defaults to args.train.batch_size
+    :return: the loader
+    """
+    batch_size = batch_size or setting.args.train.batch_size
+    key = (id(dataset), train, batch_size)
+    if key not in setting.loader_pool:
+        if train and is_distributed():
+            sampler = TaskSampler(shuffle=True, num_replicas=get_world_size(), rank=get_rank(),
+                                  seed=getattr(setting.args, 'seed', None) or 0)
+        else:
+            sampler = TaskSampler(shuffle=train)
+        setting.loader_pool[key] = DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                              **get_loader_kwargs(setting.args, train, persistent=True))
+    return TaskLoader(setting.loader_pool[key], np.asarray(indices))
+
+
 def store_masked_loaders(train_dataset: datasets, test_dataset: datasets, memory_dataset: datasets, 
                     setting: ContinualDataset, divide_tasks=True) -> Tuple[DataLoader, DataLoader]:
     """
-    masks train_dataset, memory_dataset, and test_dataset, to only an additional number of classes per task
-    then increments setting.i (ContinualDataset) by number classes of task i
+    restricts train_dataset, memory_dataset, and test_dataset, to only an additional number of classes per task
+    then increments setting.i (ContinualDataset) by number classes of task i.
+    The datasets are not modified, the loaders read TaskSubset views of them.
 
     Divides the dataset into tasks.
     :param train_dataset: train dataset
@@ -109,30 +322,16 @@ def store_masked_loaders(train_dataset: datasets, test_dataset: datasets, memory
     :return: train and test loaders
     """    
 
-    # train_dataset.data, _, train_dataset.targets, _, memory_dataset.data, _, memory_dataset.targets, _ = train_test_split(train_dataset.data, train_dataset.targets, memory_dataset.data, memory_dataset.targets, train_size=0.1, stratify=train_dataset.targets, random_state=0)    
+    if divide_tasks:
+        train_indices = get_label_index(train_dataset).indices(setting.i, setting.i + setting.N_CLASSES_PER_TASK)
+        test_indices = get_label_index(test_dataset).indices(setting.i, setting.i + setting.N_CLASSES_PER_TASK)
+    else:
+        train_indices = np.arange(len(train_dataset))
+        test_indices = np.arange(len(test_dataset))
 
-    train_mask = np.logical_and(np.array(train_dataset.targets) >= setting.i,
-        np.array(train_dataset.targets) < setting.i + setting.N_CLASSES_PER_TASK)
-    if not divide_tasks: train_mask |= True
-    test_mask = np.logical_and(np.array(test_dataset.targets) >= setting.i,
-        np.array(test_dataset.targets) < setting.i + setting.N_CLASSES_PER_TASK)
-    if not divide_tasks: test_mask |= True
-    
-    train_dataset.data = train_dataset.data[train_mask]
-    test_dataset.data = test_dataset.data[test_mask]
-
-    train_dataset.targets = np.array(train_dataset.targets)[train_mask]
-    test_dataset.targets = np.array(test_dataset.targets)[test_mask]
-
-    memory_dataset.data = memory_dataset.data[train_mask]
-    memory_dataset.targets = np.array(memory_dataset.targets)[train_mask]
-
-    train_loader = DataLoader(train_dataset,
-                              batch_size=setting.args.train.batch_size, shuffle=True, num_workers=16)
-    test_loader = DataLoader(test_dataset,
-                             batch_size=setting.args.train.batch_size, shuffle=False, num_workers=0)
-    memory_loader = DataLoader(memory_dataset,
-                              batch_size=setting.args.train.batch_size, shuffle=False, num_workers=0)
+    train_loader = get_task_loader(setting, train_dataset, train_indices, train=True)
+    test_loader = get_task_loader(setting, test_dataset, test_indices, train=False)
+    memory_loader = get_task_loader(setting, memory_dataset, train_indices, train=False)
 
     setting.test_loaders.append(test_loader)
     setting.train_loaders.append(train_loader)
@@ -166,12 +365,12 @@ def store_masked_label_loaders(train_dataset: datasets, test_dataset: datasets,
     memory_dataset.data = memory_dataset.data[train_mask]
     memory_dataset.targets = np.array(memory_dataset.labels)[train_mask]
 
-    train_loader = DataLoader(train_dataset,
-                              batch_size=setting.args.train.batch_size, shuffle=True, num_workers=4)
-    test_loader = DataLoader(test_dataset,
-                             batch_size=setting.args.train.batch_size, shuffle=False, num_workers=4)
-    memory_loader = DataLoader(memory_dataset,
-                              batch_size=setting.args.train.batch_size, shuffle=False, num_workers=4)
+    train_loader = DataLoader(train_dataset, batch_size=setting.args.train.batch_size, shuffle=True,
+                              **get_loader_kwargs(setting.args, train=True))
+    test_loader = DataLoader(test_dataset, batch_size=setting.args.train.batch_size, shuffle=False,
+                             **get_loader_kwargs(setting.args, train=False))
+    memory_loader = DataLoader(memory_dataset, batch_size=setting.args.train.batch_size, shuffle=False,
+                               **get_loader_kwargs(setting.args, train=False))
 
     setting.test_loaders.append(test_loader)
     setting.train_loaders.append(train_loader)
@@ -187,17 +386,19 @@ def store_masked_label_loaders(train_dataset: datasets, test_dataset: datasets,
 def get_previous_train_loader(train_dataset: datasets, batch_size: int,
                               setting: ContinualDataset) -> DataLoader:
     """
-    Creates a dataloader for the previous task.
+    Creates a dataloader for the previous task. In a distributed run, it only
+    loads the shard of the process, which fills its shard of the buffer.
     :param train_dataset: the entire training set
     :param batch_size: the desired batch size
     :param setting: the continual dataset at hand
     :return: a dataloader
     """
-    train_mask = np.logical_and(np.array(train_dataset.targets) >=
-        setting.i - setting.N_CLASSES_PER_TASK, np.array(train_dataset.targets)
-        < setting.i - setting.N_CLASSES_PER_TASK + setting.N_CLASSES_PER_TASK)
-
-    train_dataset.data = train_dataset.data[train_mask]
-    train_dataset.targets = np.array(train_dataset.targets)[train_mask]
-
-    return DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
+    indices = get_label_index(train_dataset).indices(setting.i - setting.N_CLASSES_PER_TASK, setting.i)
+
+    if not is_distributed():
+        return DataLoader(TaskSubset(train_dataset, indices), batch_size=batch_size, shuffle=True)
+    # the same permutation on every process, a new one at each task
+    sampler = TaskSampler(shuffle=True, num_replicas=get_world_size(), rank=get_rank(),
+                          seed=(getattr(setting.args, 'seed', None) or 0) + setting.i)
+    sampler.indices = np.arange(len(indices))
+    return DataLoader(TaskSubset(train_dataset, indices), batch_size=batch_size, sampler=sampler)
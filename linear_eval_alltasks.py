@@ -1,58 +1,131 @@
 import os
+import types
+import numpy as np
 import torch
-import torch.nn as nn
-import torch.nn.functional as F 
-import torchvision
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset, BatchSampler, SequentialSampler
 from tqdm import tqdm
 from arguments import get_args
-from augmentations import get_aug
-from models import get_model, get_backbone
-from tools import AverageMeter, knn_monitor
+from models import get_backbone
+from tools import knn_monitor
 from datasets import get_dataset
-from models.optimizers import get_optimizer, LR_Scheduler
 from utils.loggers import *
 
 
-def evaluate_single(model, dataset, test_loader, memory_loader, device, k, last=False) -> Tuple[list, list, list, list]:
-    accs, accs_mask_classes = [], []
-    knn_accs, knn_accs_mask_classes = [], []
-    correct = correct_mask_classes = total = 0
-    knn_acc, knn_acc_mask = knn_monitor(model.net.module.backbone, dataset, memory_loader, test_loader, device, args.cl_default, task_id=k, k=min(args.train.knn_k, len(dataset.memory_loaders[k].dataset))) 
+class CachedTask(TensorDataset):
+    """
+    The samples of a task after the eval transform, as (inputs, targets) tensors.
+    """
+    @property
+    def targets(self) -> np.ndarray:
+        return self.tensors[1].numpy()
 
-    return knn_acc
+
+def cache_task(loader, desc) -> CachedTask:
+    inputs, targets = [], []
+    for data, target, *meta_args in tqdm(loader, desc=desc, leave=False):
+        inputs.append(data)
+        targets.append(target)
+    return CachedTask(torch.cat(inputs).share_memory_(), torch.cat(targets).share_memory_())
+
+
+def cached_loader(task: CachedTask, batch_size: int) -> DataLoader:
+    # every batch is a single slice of the cached tensors
+    return DataLoader(task, sampler=BatchSampler(SequentialSampler(task), batch_size, drop_last=False),
+                      batch_size=None)
+
+
+def load_backbone(backbone, model_path):
+    """
+    Loads the backbone weights of a checkpoint saved by main, dropping the
+    projector, predictor and optimizer state.
+    """
+    save_dict = torch.load(model_path, map_location='cpu')
+    state_dict = {k.split('backbone.', 1)[1]: v for k, v in save_dict['state_dict'].items()
+                  if k.startswith('backbone.') or k.startswith('module.backbone.')}
+    return backbone.load_state_dict(state_dict, strict=True)
+
+
+_worker = {}
+
+
+def init_worker(devices, setting, tasks, config):
+    device = devices.get()
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    else:
+        torch.set_num_threads(config['num_threads'])
+    _worker.update(device=device, setting=setting, tasks=tasks, config=config)
+
+
+def evaluate_checkpoint(model_path):
+    """
+    kNN accuracies, plain and with the classes of the task only, of the
+    backbone of model_path on every task.
+    """
+    device, setting, tasks, config = _worker['device'], _worker['setting'], _worker['tasks'], _worker['config']
+    backbone = get_backbone(config['backbone'], setting.NAME, config['cl_default']).to(device)
+    load_backbone(backbone, model_path)
+
+    accs, accs_mask = [], []
+    for t, (memory_task, test_task) in enumerate(tasks):
+        acc, acc_mask = knn_monitor(backbone, setting, cached_loader(memory_task, config['batch_size']),
+                                    cached_loader(test_task, config['batch_size']), device, config['cl_default'],
+                                    task_id=t, k=min(config['knn_k'], len(memory_task)), debug=config['debug'])
+        accs.append(acc)
+        accs_mask.append(acc_mask)
+    return accs, accs_mask
 
 
 def main(device, args):
+    """
+    kNN accuracy of the checkpoint of every task on every task. The splits are
+    loaded once and the samples of each task are cached after the eval
+    transform, in shared memory; the checkpoints are then evaluated in
+    parallel, one per device on cuda, one per worker process on cpu.
+    """
+    dataset = get_dataset(args)
+    for t in tqdm(range(dataset.N_TASKS), desc='Caching tasks'):
+        dataset.get_data_loaders(args)
+    tasks = [(cache_task(memory_loader, f'Caching memory {t}'), cache_task(test_loader, f'Caching test {t}'))
+             for t, (memory_loader, test_loader) in enumerate(zip(dataset.memory_loaders, dataset.test_loaders))]
+    model_paths = [os.path.join(args.ckpt_dir, f"{args.model.cl_model}_{args.name}_{t}.pth") for t in range(dataset.N_TASKS)]
+
+    device = torch.device(device)
+    if device.type == 'cuda':
+        devices = [torch.device('cuda', i) for i in range(torch.cuda.device_count())] if device.index is None else [device]
+    else:
+        devices = [device] * min(len(model_paths), os.cpu_count())
+    # what the workers need of the dataset and args, which are not sent to them
+    setting = types.SimpleNamespace(NAME=dataset.NAME, SETTING=dataset.SETTING, N_TASKS=dataset.N_TASKS,
+                                    N_CLASSES_PER_TASK=dataset.N_CLASSES_PER_TASK)
+    config = {
+        'backbone': args.model.backbone,
+        'cl_default': args.cl_default,
+        'batch_size': args.train.batch_size,
+        'knn_k': args.train.knn_k,
+        'debug': args.debug,
+        'num_threads': max(1, os.cpu_count() // len(devices)),
+    }
+
+    ctx = mp.get_context('spawn')
+    device_queue = ctx.Queue()
+    for d in devices:
+        device_queue.put(d)
+    with ctx.Pool(len(devices), initializer=init_worker, initargs=(device_queue, setting, tasks, config)) as pool:
+        results = list(tqdm(pool.imap(evaluate_checkpoint, model_paths), total=len(model_paths), desc='Evaluating'))
+    # [checkpoint, task]
+    knn_acc = np.array([accs for accs, _ in results])
+    knn_acc_mask = np.array([accs_mask for _, accs_mask in results])
+    for t, accs in enumerate(knn_acc):
+        print(f'Task {t}: {accs.tolist()}')
+    np.save(os.path.join(args.log_dir, 'knn_acc.npy'), knn_acc)
+    np.save(os.path.join(args.log_dir, 'knn_acc_mask.npy'), knn_acc_mask)
+
+    mean_knn_acc = knn_acc[-1].mean()
+    print(f'KNN accuracy on Task {dataset.N_TASKS - 1}: {mean_knn_acc}')
 
-    dataset_copy = get_dataset(args)
-    train_loader, memory_loader, test_loader = dataset_copy.get_data_loaders(args)
-    model = get_model(args, device, len(train_loader), get_aug(train=False, train_classifier=False, **args.aug_kwargs))
-
-    for t in range(dataset_copy.N_TASKS - 1):
-        _, _, _ = dataset_copy.get_data_loaders(args)
-
-    knn_acc = []
-    for t in tqdm(range(0, dataset_copy.N_TASKS), desc='Evaluatinng'):
-      dataset = get_dataset(args)
-      model_path = os.path.join(args.ckpt_dir, f"{args.model.cl_model}_{args.name}_{t}.pth")
-      save_dict = torch.load(model_path, map_location='cpu')
-
-      msg = model.net.module.backbone.load_state_dict({k[16:]:v for k, v in save_dict['state_dict'].items() if 'backbone.' in k}, strict=True)
-      model = model.to(args.device)
-    
-      task_knn_acc = []
-      for t1 in tqdm(range(0, dataset_copy.N_TASKS), desc='Inner tasks'):
-        train_loader, memory_loader, test_loader = dataset.get_data_loaders(args)
-        t1_knn_acc = evaluate_single(model, dataset, test_loader, memory_loader, device, t1)
-        task_knn_acc.append(t1_knn_acc)
-      knn_acc.append(task_knn_acc)
-      print(f'Task {t}: {task_knn_acc}')
-    
-    mean_knn_acc = sum(knn_acc[-1][:len(knn_acc[-1])]) / len(knn_acc[-1])
-    print(f'KNN accuracy on Task {t1}: {mean_knn_acc}')
-
-    max_knn_acc = [max(idx) for idx in zip(*knn_acc)]
-    mean_knn_fgt = sum([x1 - x2 for (x1, x2) in zip(max_knn_acc, knn_acc[-1])]) / len(knn_acc[-1])
+    mean_knn_fgt = (knn_acc.max(axis=0) - knn_acc[-1]).mean()
     print(f'KNN Forgetting: {mean_knn_fgt}')
 
 
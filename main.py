@@ -13,16 +13,20 @@ import time
 from sklearn.model_selection import ParameterGrid
 
 from arguments import get_args, update_args, init_args
-from augmentations import get_aug
-from models import get_model, get_num_params, get_head, get_features
+from augmentations import get_aug, get_gpu_aug
+from models import MODELS, get_model, get_num_params, get_head, get_features
 from tools import AverageMeter, knn_monitor, probe_monitor, logistic_monitor, Logger, file_exist_check
-from datasets import get_dataset
+from datasets import get_dataset, load_shared_splits
 from datetime import datetime
 from utils.loggers import *
 from utils.metrics import mask_classes
 from utils.loggers import CsvLogger
-from datasets.utils.continual_dataset import ContinualDataset
+from datasets.utils.continual_dataset import ContinualDataset, import_splits, unique_tmp_path
 from models.utils.continual_model import ContinualModel
+from models.utils.head_bank import HeadBank
+from models.utils.feature_cache import FeatureCache
+from utils.profiler import StepProfiler
+from utils.distributed import init_distributed, cleanup_distributed, is_main_process, get_world_size
 from models.utils.gradient import *
 from typing import Tuple
 from copy import deepcopy
@@ -35,7 +39,7 @@ def probe_evaluate(args, t, dataset, model, device, memory_loader, all_probe_res
   probe_train_results = []
   probe_results = []
   for i in range(len(dataset.test_loaders)):
-    train_acc, acc, best_c = logistic_monitor(model.net.backbone, dataset, dataset.memory_loaders[i], dataset.test_loaders[i], device, args.cl_default, task_id=t, k=min(args.train.knn_k, len(memory_loader.dataset)), debug=args.debug and args.debug_lpft) 
+    train_acc, acc, best_c = logistic_monitor(model.net.module.backbone, dataset, dataset.memory_loaders[i], dataset.test_loaders[i], device, args.cl_default, task_id=t, k=min(args.train.knn_k, len(memory_loader.dataset)), debug=args.debug and args.debug_lpft) 
     probe_results.append(acc)
     probe_train_results.append(train_acc)
     if not args.debug_lpft and "tune" in os.environ["logging"]: 
@@ -80,40 +84,67 @@ def evaluate(model: ContinualModel, dataset: ContinualDataset, device, classifie
              and task-il accuracy for each task
     """
     assert not classifier or not fc
-    if fc: assert isinstance(fc, list) and len(fc) == len(dataset.test_loaders)
+    if fc:
+      assert isinstance(fc, list) and len(fc) == len(dataset.test_loaders)
+      _, fc_accs, _ = evaluate_heads(model, dataset, device, HeadBank.from_heads(fc), debug=debug)
+      return fc_accs
+    accs, _, _ = evaluate_heads(model, dataset, device, classifier=classifier, debug=debug)
+    return accs
+
+
+def evaluate_heads(model, dataset: ContinualDataset, device, fc=None, classifier=None, debug=False):
+    """
+    Evaluates, in a single pass over the test loaders, the model (or classifier
+    on its outputs) and the task heads fc. The features of a batch are
+    computed once and fed to all the heads as one einsum; correct predictions
+    are counted on the device and read back once at the end.
+    :param model: the backbone to be evaluated
+    :param dataset: the continual dataset at hand
+    :param fc: HeadBank of the task heads, its k-th head is the one of the k-th test loader
+    :param classifier: applied to the outputs of the model
+    :return: the class-il and task-il accuracies of the model for each task,
+             the same for the task heads (None without fc), and the class-il
+             accuracy of every task head on every task ([task][head], None without fc)
+    """
+    if fc is not None: assert len(fc.weight) >= len(dataset.test_loaders)
     status = model.training
     model.eval()
-    accs, accs_mask_classes = [], []
-    for k, test_loader in enumerate(dataset.test_loaders):
-      correct, correct_mask_classes, total = 0.0, 0.0, 0.0
-      for (inputs, labels, *meta_args) in tqdm(test_loader):
-          inputs, labels = inputs.to(device), labels.to(device)            
-          if fc:             
-            outputs = get_features(model, inputs)
-          else:
-            outputs = model(inputs)
-          
-          if classifier is not None:
-            outputs = classifier(outputs)
-          elif fc is not None:
-            outputs = fc[k](outputs)
-
-          _, pred = torch.max(outputs.data, 1)
-          correct += torch.sum(pred == labels).item()
-          total += labels.shape[0]
-
-          if dataset.SETTING == 'class-il' or dataset.SETTING == 'domain-il':              
-            mask_classes(outputs, dataset, k if dataset.SETTING == 'class-il' else 0)
-            _, pred = torch.max(outputs.data, 1)
-            correct_mask_classes += torch.sum(pred == labels).item()
-
-          if debug and total: break
-      
-      accs.append(correct / total * 100)
-      accs_mask_classes.append(correct_mask_classes / total * 100)
-
+    n_tasks = len(dataset.test_loaders)
+    mask = dataset.SETTING == 'class-il' or dataset.SETTING == 'domain-il'
+    # [class-il, task-il] x [model, task heads] correct predictions of each task
+    correct = torch.zeros(2, 2, n_tasks, dtype=torch.long, device=device)
+    head_correct = torch.zeros(n_tasks, n_tasks if fc is not None else 0, dtype=torch.long, device=device)
+    totals = [0] * n_tasks
+    with torch.no_grad():
+      for k, test_loader in enumerate(dataset.test_loaders):
+        for (inputs, labels, *meta_args) in tqdm(test_loader):
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            if fc is not None:
+              features = get_features(model, inputs)
+              outputs = get_head(model)(features)
+              head_outputs = fc(features, n_tasks)
+              head_correct[k] += (head_outputs.argmax(dim=2) == labels[:, None]).sum(dim=0)
+              all_outputs = [outputs, head_outputs[:, k]]
+            else:
+              outputs = model(inputs)
+              all_outputs = [classifier(outputs) if classifier is not None else outputs]
+
+            for i, outputs in enumerate(all_outputs):
+              correct[0, i, k] += (outputs.argmax(dim=1) == labels).sum()
+              if mask:
+                mask_classes(outputs, dataset, k if dataset.SETTING == 'class-il' else 0)
+                correct[1, i, k] += (outputs.argmax(dim=1) == labels).sum()
+            totals[k] += labels.shape[0]
+
+            if debug and totals[k]: break
+
+    correct, head_correct = correct.tolist(), head_correct.tolist()
+    accs = [[c / total * 100 for c, total in zip(correct[il][i], totals)] for il in range(2) for i in range(2)]
     model.train(status)
-    return accs, accs_mask_classes
+    if fc is None:
+      return (accs[0], accs[2]), None, None
+    head_accs = [[c / total * 100 for c in task_correct] for task_correct, total in zip(head_correct, totals)]
+    return (accs[0], accs[2]), (accs[1], accs[3]), head_accs
 
 
 def save_model(model, args, t, epoch, dataset):
@@ -126,48 +157,123 @@ def save_model(model, args, t, epoch, dataset):
     model_path = os.path.join(args.ckpt_dir, f"{args.model.cl_model}_{args.name}_{t}_last.pth")  
     
 
-  torch.save({
-    'epoch': epoch+1,
-    'state_dict':model.net.state_dict(),
-    'opt_state_dict':model.opt.state_dict()
-  }, model_path)
+  # every process holds the same weights, only the main one writes them
+  if is_main_process():
+    torch.save({
+      'epoch': epoch+1,
+      'state_dict':model.net.state_dict(),
+      'opt_state_dict':model.opt.state_dict()
+    }, model_path)
 
-  print(f"Task Model saved to {model_path}")
+    print(f"Task Model saved to {model_path}")
 
-  with open(os.path.join(args.log_dir, f"checkpoint_path.txt"), 'w+') as f:
-    f.write(f'{model_path}')
+    with open(os.path.join(args.log_dir, f"checkpoint_path.txt"), 'w+') as f:
+      f.write(f'{model_path}')
   
   if hasattr(model, 'end_task'):
     model.end_task(dataset)
 
+def save_trial_checkpoint(model, t, head_bank, results):
+  """
+  Checkpoints a trial at the end of task t, for tune to resume it (e.g. when
+  a scheduler pauses it, or after a failure).
+  :param head_bank: the task heads stored so far (cl_default), or None
+  :param results: the accuracy lists of the tasks trained so far (all_task_results...)
+  """
+  with tune.checkpoint_dir(step=t) as checkpoint_dir:
+    torch.save({
+      'task': t,
+      'state_dict': model.net.state_dict(),
+      'opt_state_dict': model.opt.state_dict(),
+      # rehearsal buffer, regularization terms, LP-FT frozen parameters...
+      'method_state': model.method_state(),
+      'head_bank': head_bank.state_dict() if head_bank is not None else None,
+      # plain floats, which torch.load reads back with weights_only
+      'results': [[[float(acc) for acc in accs] for accs in lists] for lists in results],
+    }, os.path.join(checkpoint_dir, "trial.pth"))
+
+
+def load_trial_checkpoint(model, checkpoint_dir, device):
+  """
+  Restores a trial checkpointed by save_trial_checkpoint.
+  :return: the first task left to train, the head bank and the accuracy lists
+  """
+  save_dict = torch.load(os.path.join(checkpoint_dir, "trial.pth"), map_location='cpu')
+  model.net.load_state_dict(save_dict['state_dict'])
+  # first: the optimizer state leaves out the parameters frozen by LP-FT
+  model.load_method_state(save_dict['method_state'])
+  model.opt.load_state_dict(save_dict['opt_state_dict'])
+  head_bank = None
+  if save_dict['head_bank'] is not None:
+    head_bank = HeadBank(*save_dict['head_bank']['weight'].shape, device)
+    head_bank.load_state_dict(save_dict['head_bank'])
+  return save_dict['task'] + 1, head_bank, save_dict['results']
+
+
+def get_scheduler(args):
+  """
+  Trial scheduler of the sweep (train.scheduler: asha or median, None runs
+  every trial to the end) stopping the trials whose knn_mean_acc is
+  dominated. Time is counted in tasks (task_progress), so that trials are
+  compared at the same (task, epoch) point whatever their number of epochs
+  per task, and grace periods and ASHA rungs (train.grace_tasks,
+  train.reduction_factor) fall at task boundaries.
+  """
+  name = getattr(args.train, 'scheduler', None)
+  if not name:
+    return None
+  kwargs = dict(time_attr='task_progress', metric='knn_mean_acc', mode='max',
+                grace_period=getattr(args.train, 'grace_tasks', 1))
+  if name == 'asha':
+    return tune.schedulers.ASHAScheduler(max_t=get_dataset(args).N_TASKS,
+                                         reduction_factor=getattr(args.train, 'reduction_factor', 3), **kwargs)
+  if name == 'median':
+    return tune.schedulers.MedianStoppingRule(**kwargs)
+  raise ValueError(f"unknown scheduler {name}, choose from asha, median")
+
+
+def check_scheduler(args, grid):
+  """
+  Checks, before the trials are launched, that each one of the grid can run
+  under its train.scheduler: trials are compared on knn_mean_acc, which needs
+  knn_monitor, and are paused and resumed from their trial checkpoints.
+  :param grid: the train config grid of train, over args.train
+  """
+  for train_config in ParameterGrid(grid):
+    resolved = lambda k: train_config.get(k, getattr(args.train, k, None))
+    if not resolved('scheduler'):
+      continue
+    assert resolved('knn_monitor'), f"train.scheduler compares trials on knn_mean_acc, it needs knn_monitor ({train_config})"
+    assert MODELS[args.model.cl_model].RESUMABLE, f"train.scheduler resumes trials, {args.model.cl_model} cannot be resumed"
+
+
 def freeze_weights(model, args, only_log=False):
 
-  extract_name = lambda x: x[0].split('.')[0] if args.cl_default else '.'.join(x[0].split('.')[1:3])
+  extract_name = lambda x: x[0].split('.')[0] if args.cl_default else '.'.join(x[0].split('.')[0:2])
 
   num_frozen = 0
   frozen = []
-  norm_avg = defaultdict(int)
-  norm_avg_counts = defaultdict(int)
-  all_params = list((model.net.backbone if args.cl_default else model).named_parameters())
+  all_params = list((model.net.module.backbone if args.cl_default else model.net.module).named_parameters())
   if not args.train.freeze_include_head:
     head_name = "fc" if args.cl_default else "predictor"
-    all_params = list(filter(lambda param: param[0].split('.')[0 if args.cl_default else 1] != head_name, all_params))
-
-  for (norm, x) in model_param_filter(all_params, float("inf")): 
-    norm_avg[extract_name(x)] += norm
-    norm_avg_counts[extract_name(x)+"_count"] += 1  
-
-  for k in norm_avg:
-    norm_avg[k] /= norm_avg_counts[k+"_count"]
-
-  if len(norm_avg):
-    for k in norm_avg:
+    all_params = list(filter(lambda param: param[0].split('.')[0] != head_name, all_params))
+
+  # gradient statistics accumulated on the device over the steps of the last epoch
+  # (none before the first one), per parameter and averaged per layer, read back in one copy
+  if model.grad_stats is None or not model.grad_stats.covers(all_params):
+    model.grad_stats = GradStatsCollector(all_params, extract_name)
+  stats = model.grad_stats.collect()
+  norm_avg = stats['layer_norm']
+  abs_mean_avg = stats['layer_abs_mean']
+
+  if len(abs_mean_avg):
+    for k in abs_mean_avg:
       if not args.debug_lpft and "tune" in os.environ["logging"]: 
-        tune.report(**{f"grad/{k}_grad_abs_mean": float(norm_avg[k])})
+        tune.report(**{f"grad/{k}_grad_abs_mean": abs_mean_avg[k]})
       if not args.debug_lpft and "wandb" in os.environ["logging"]: 
-        wandb.log({f"grad/{k}_grad_abs_mean": float(norm_avg[k])})
+        wandb.log({f"grad/{k}_grad_abs_mean": abs_mean_avg[k]})
       if args.debug_lpft:
-        print({f"grad/{k}_grad_abs_mean": float(norm_avg[k])})
+        print({f"grad/{k}_grad_abs_mean": abs_mean_avg[k]})
 
   if only_log: return
 
@@ -183,7 +289,7 @@ def freeze_weights(model, args, only_log=False):
     layer_names = sorted(norm_avg, key=lambda x: (norm_avg[x], tiebreak.index(x)))[:num_layers]
     params_to_freeze = [(0., x) for x in all_params if extract_name(x) in layer_names]
   else:
-    params_to_freeze = model_param_filter(all_params, args.train.grad_thresh)
+    params_to_freeze = model_param_filter(all_params, args.train.grad_thresh, norms=stats['norm'])
     params_to_freeze = sorted(params_to_freeze, key=lambda x: tiebreak.index(extract_name(x[1])))
 
   for (norm, x) in params_to_freeze:        
@@ -196,22 +302,58 @@ def freeze_weights(model, args, only_log=False):
 
   if args.train.reset_lp_lr:
     for pg in model.opt.param_groups:
-      pg['lr'] = args.train.lp_lr*args.train.batch_size/256
+      pg['lr'] = args.train.lp_lr*args.train.batch_size*get_world_size()/256
   if not args.cl_default and args.train.proj_is_head:
-    model.net.projector.requires_grad_(False)      
+    model.net.module.projector.requires_grad_(False)      
+  model.update_frozen_params()
 
 def unfreeze_weights(model, args):
-  model.net.backbone.requires_grad_(True)          
+  model.net.module.backbone.requires_grad_(True)          
   for pg in model.opt.param_groups:
-    pg['lr'] = args.train.ft_lr*args.train.batch_size/256
+    pg['lr'] = args.train.ft_lr*args.train.batch_size*get_world_size()/256
   if not args.cl_default:
-    model.net.projector.requires_grad_(True)
-    model.net.predictor.requires_grad_(True)
-
-
-def trainable(config):
+    model.net.module.projector.requires_grad_(True)
+    model.net.module.predictor.requires_grad_(True)
+  model.update_frozen_params()
+
+
+def cache_lp_features(model, args, train_loader, gpu_aug, device):
+  """
+  FeatureCache of the task for the linear probing epochs, if train.lp_feature_cache
+  is set ('device' or 'memmap'), the model can train from features and its
+  whole backbone is frozen; None otherwise.
+  """
+  mode = getattr(args.train, 'lp_feature_cache', False)
+  backbone = model.net.module.backbone
+  head = set(get_head(backbone).parameters())
+  if not mode or not hasattr(model, 'observe_features') or any(p.requires_grad for p in backbone.parameters() if p not in head):
+    return None
+  assert mode in ['device', 'memmap'], f"unknown lp_feature_cache {mode}"
+  n_views = 1 if args.cl_default else 2
+  draws = getattr(args.train, 'lp_cache_draws', 1)
+  # log_dir is shared by the trials (and ranks) of the sweep: a file of its own for each
+  path = unique_tmp_path(os.path.join(args.log_dir, 'lp_features.npy')) if mode == 'memmap' else None
+  cache = FeatureCache(len(train_loader) * train_loader.batch_size, n_views, backbone.output_dim, draws, device, path)
+  status = backbone.training
+  backbone.eval()
+  with torch.no_grad():
+    for draw in range(draws):
+      for images, labels, *meta_args in tqdm(train_loader, desc=f'Caching features {draw}', disable=args.hide_progress):
+        if gpu_aug is not None:
+          images = gpu_aug(images.to(device, non_blocking=True))
+        views = [images[v].to(device, non_blocking=True) for v in range(n_views)]
+        features = torch.stack([model.embed(view) for view in views], dim=1)
+        cache.add(draw, features, labels.to(device, non_blocking=True))
+  backbone.train(status)
+  return cache
+
+
+def trainable(config, checkpoint_dir=None, splits=None):
   # WANDB    
   
+  # dataset splits shared by the trials of the node, see train
+  if splits:
+    import_splits(splits)
   args = config["default_args"]
   device = args["device"]
   
@@ -224,10 +366,12 @@ def trainable(config):
       args["aug_kwargs"][k] = v
   
   args['train'] = update_args(args['train'], 'stop_at_epoch', args['train'].num_epochs)
+  scheduler = getattr(args['train'], 'scheduler', None)
+  assert not scheduler or args['train'].knn_monitor, "train.scheduler compares trials on knn_mean_acc, it needs knn_monitor"
 
   assert not args['train'].all_tasks_num_epochs or not args['train'].probe_monitor
   
-  if args['train'].disable_logging:
+  if args['train'].disable_logging or not is_main_process():
     os.environ['logging'] = ""
   else:
     os.environ['logging'] = "wandb,tune"
@@ -240,13 +384,14 @@ def trainable(config):
   # args.train.warmup_epochs = int(args.train.warmup_lp_epoch_f * args.train.num_epochs)
 
   dataset = get_dataset(args)
-  dataset_copy = get_dataset(args)
-  train_loader, memory_loader, test_loader = dataset_copy.get_data_loaders(args, divide_tasks=args.train.all_tasks_num_epochs > 0)
+  # loaders of the first task, also used below to size the lr schedule
+  train_loader, memory_loader, test_loader = dataset.get_data_loaders(args, divide_tasks=args.train.all_tasks_num_epochs > 0)
 
   # define model
   model = get_model(args, device, len(train_loader), dataset.get_transform(args))
+  assert not scheduler or model.RESUMABLE, f"train.scheduler resumes trials, {args.model.cl_model} cannot be resumed"
 
-  backbone_n_params = get_num_params(model.net.backbone)
+  backbone_n_params = get_num_params(model.net.module.backbone)
   if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(backbone_n_params=backbone_n_params)
   if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({'backbone_n_params': backbone_n_params})
 
@@ -258,20 +403,38 @@ def trainable(config):
     model_path = os.path.join(args.ckpt_dir, f"{args.model.cl_model}_{args.name}_{3}_orig.pth")
     save_dict = torch.load(model_path, map_location='cpu')
     msg = model.net.module.backbone.load_state_dict({k[16:]:v for k, v in save_dict['state_dict'].items() if 'backbone.' in k and 'fc' not in k}, strict=True) 
-    model.net.opt.load_state_dict(save_dict['opt_state_dict'])   
+    model.opt.load_state_dict(save_dict['opt_state_dict'])   
 
-  old_fcs = []
+  head_bank = None
   all_task_results = []
 
   all_probe_results = []
   all_probe_train_results = []
 
+  # trial paused or restarted by tune: resume after its last completed task
+  start_task = 0
+  if checkpoint_dir:
+    start_task, head_bank, results = load_trial_checkpoint(model, checkpoint_dir, device)
+    all_task_results, all_probe_results, all_probe_train_results = results
+
+  # None unless the two views are made on the device (dataset.gpu_aug)
+  gpu_aug = get_gpu_aug(**args.aug_kwargs)
+
+  if getattr(args.train, 'profile', False):
+    model.profiler = StepProfiler(args.log_dir, name=args.model.cl_model, device=device,
+                                  trace_window=getattr(args.train, 'profile_trace', None))
+  profiler = model.profiler
+
   for t in range(dataset.N_TASKS):
     best_current_task = float("-inf")
-    train_loader, memory_loader, test_loader = dataset.get_data_loaders(args, divide_tasks=args.train.all_tasks_num_epochs > 0)
+    if t:
+      train_loader, memory_loader, test_loader = dataset.get_data_loaders(args, divide_tasks=args.train.all_tasks_num_epochs > 0)
     if args.last and t < 4: 
       print("continuing cause only train last task...")
       continue
+    if t < start_task:
+      print(f"task {t} restored from the trial checkpoint")
+      continue
 
     if args.train.all_tasks_num_epochs and t == dataset.N_TASKS - 1:
       global_progress = tqdm(range(0, args.train.all_tasks_num_epochs), desc=f'Training all tasks')
@@ -281,11 +444,20 @@ def trainable(config):
     print("at start of task, cuda allocated", print("knn cuda allocated", torch.cuda.memory_allocated()))
 
     epoch = 0
+    lp_cache = None
     for epoch in global_progress:   
       if args.lpft and (not args.train.ft_first or t):    
         freeze_weights(model, args, only_log=epoch)          
+        # only if linear probing epochs will train from it
+        if epoch == 0 and args.train.num_lp_epochs > 0:
+          with profiler.phase('feature_cache'):
+            lp_cache = cache_lp_features(model, args, train_loader, gpu_aug, device)
         if epoch == args.train.num_lp_epochs:
           unfreeze_weights(model, args)
+          # back to the live forward of the backbone
+          if lp_cache is not None:
+            lp_cache.close()
+            lp_cache = None
       if not args.train.train_first or not t:
         model.train()
       else:
@@ -295,11 +467,33 @@ def trainable(config):
 
       print(f"before training batch in epoch {epoch}, cuda allocated", torch.cuda.memory_allocated())
 
-      for idx, ((images1, images2, notaug_images), labels, *meta_args) in enumerate(local_progress):
+      # linear probing from the cached features of the frozen backbone
+      for idx, (features, labels) in enumerate(profiler.iterate(lp_cache.batches(epoch, train_loader.batch_size) if lp_cache is not None else [])):
+        data_dict = model.observe_features(features[0], labels, features[-1])
+        profiler.step()
+
+        with profiler.phase('logging'):
+          if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(loss=data_dict['loss'].item())
+          if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({'loss': data_dict['loss'].item()})
+        if args.debug_lpft and idx == 1: break
+
+      for idx, (images, labels, *meta_args) in enumerate(profiler.iterate(local_progress if lp_cache is None else [])):
+        with profiler.phase('h2d'):
+          if gpu_aug is not None:
+            images = images.to(device, non_blocking=True)
+          else:
+            images = [images[0].to(device, non_blocking=True), images[1].to(device, non_blocking=True), images[2]]
+          labels = labels.to(device, non_blocking=True)
+        if gpu_aug is not None:
+          with profiler.phase('augment'):
+            images = gpu_aug(images)
+        images1, images2, notaug_images = images
         data_dict = model.observe(images1, labels, images2, notaug_images)
+        profiler.step()
 
-        if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(loss=data_dict['loss'].item())
-        if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({'loss': data_dict['loss'].item()})
+        with profiler.phase('logging'):
+          if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(loss=data_dict['loss'].item())
+          if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({'loss': data_dict['loss'].item()})
         if idx == 0:
           print("after first batch, cuda allocated", torch.cuda.memory_allocated())        
         elif idx == 1:
@@ -314,53 +508,63 @@ def trainable(config):
       print(f"after looping all batches in epoch {epoch}, cuda allocated", torch.cuda.memory_allocated())           
 
       if args.train.knn_monitor and epoch % args.train.knn_interval == 0: 
-        results, results_mask_classes = [], []
-        for i in range(len(dataset.test_loaders)):
-          acc, acc_mask = knn_monitor(model.net.backbone, dataset, dataset.memory_loaders[i], dataset.test_loaders[i], device, args.cl_default, task_id=t, k=min(args.train.knn_k, len(memory_loader.dataset)), debug=args.debug and args.debug_lpft)             
-
-          results.append(acc)
-          if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(**{f"knn_acc_task_{i+1}": acc})
+        with profiler.phase('knn_monitor'):
+          results, results_mask_classes = [], []
+          for i in range(len(dataset.test_loaders)):
+            acc, acc_mask = knn_monitor(model.net.module.backbone, dataset, dataset.memory_loaders[i], dataset.test_loaders[i], device, args.cl_default, task_id=t, k=min(args.train.knn_k, len(memory_loader.dataset)), debug=args.debug and args.debug_lpft)             
+
+            results.append(acc)
+            if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(**{f"knn_acc_task_{i+1}": acc})
+            if args.debug_lpft:
+              print({f"knn_acc_task_{i+1}": acc})
+            if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({f"knn_acc_task_{i+1}": acc})
+          if not epoch:
+            all_task_results.append(results)
+          else:
+            all_task_results[-1] = results
+          if args.train.naive:
+            mean_acc = np.mean([all_task_results[i][i] for i in range(len(dataset.test_loaders))])
+          else:
+            mean_acc = np.mean(results)
+          # tasks trained so far, the time of the trial scheduler: trials are compared at the same point of the sequence
+          task_progress = t + (epoch + 1) / len(global_progress)
+          if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(**{f"knn_mean_acc": mean_acc, "task_progress": task_progress})
           if args.debug_lpft:
-            print({f"knn_acc_task_{i+1}": acc})
-          if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({f"knn_acc_task_{i+1}": acc})
-        if not epoch:
-          all_task_results.append(results)
-        else:
-          all_task_results[-1] = results
-        if args.train.naive:
-          mean_acc = np.mean([all_task_results[i][i] for i in range(len(dataset.test_loaders))])
-        else:
-          mean_acc = np.mean(results)
-        if not args.debug_lpft and "tune" in os.environ["logging"]: tune.report(**{f"knn_mean_acc": mean_acc})
-        if args.debug_lpft:
-          print({f"knn_mean_acc": mean_acc})
-        if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({f"knn_mean_acc": mean_acc})
+            print({f"knn_mean_acc": mean_acc})
+          if not args.debug_lpft and "wandb" in os.environ["logging"]: wandb.log({f"knn_mean_acc": mean_acc})
               
-        epoch_dict = {"epoch":epoch, "accuracy": mean_acc}
-        print("mean_accuracy:", mean_acc)
-        global_progress.set_postfix(epoch_dict)
-        logger.update_scalers(epoch_dict)
+          epoch_dict = {"epoch":epoch, "accuracy": mean_acc}
+          print("mean_accuracy:", mean_acc)
+          global_progress.set_postfix(epoch_dict)
+          logger.update_scalers(epoch_dict)
 
       if args.train.save_best and results[-1] > best_current_task:
         print(f"{results[-1]} beats {best_current_task}, saving model...")
         best_current_task = results[-1]
-        save_model(model,args,t,epoch,dataset)
+        with profiler.phase('checkpoint'):
+          save_model(model,args,t,epoch,dataset)
 
       if args.train.probe_monitor and epoch % args.train.probe_interval == 0:
-        probe_evaluate(args, t, dataset, model, device, memory_loader, all_probe_results, all_probe_train_results, end_task=False)
+        with profiler.phase('probe_monitor'):
+          probe_evaluate(args, t, dataset, model, device, memory_loader, all_probe_results, all_probe_train_results, end_task=False)
 
       ## BELOW for task-il evaluation, not including for domain-il
 
       if args.cl_default:  
-        old_fcs.append(deepcopy(get_head(model.net.backbone)))      
-        accs = evaluate(model.net.backbone, dataset, device, debug=args.debug and args.debug_lpft)
-        # results_mask_classes.append(accs[1])
-        mean_acc = accs[0]
-        if args.train.all_tasks_num_epochs > 0:
-          # use the last fc each test task         
-          old_fcs = [old_fcs[-1] for _ in range(dataset.N_TASKS)]
-        task_accs = evaluate(model.net.backbone, dataset, device, fc=old_fcs, debug=args.debug and args.debug_lpft)
-        mean_acc_task_il = np.mean(task_accs,axis=1)
+        with profiler.phase('evaluate'):
+          head = get_head(model.net.module.backbone)
+          if head_bank is None:
+            head_bank = HeadBank(dataset.N_TASKS, head.out_features, head.in_features, device)
+          if args.train.all_tasks_num_epochs > 0:
+            # use the last fc each test task
+            head_bank.store(slice(None), head)
+          else:
+            # refreshed in place every epoch, holds the head of task t as it ends
+            head_bank.store(t, head)
+          accs, task_accs, _ = evaluate_heads(model.net.module.backbone, dataset, device, fc=head_bank, debug=args.debug and args.debug_lpft)
+          # results_mask_classes.append(accs[1])
+          mean_acc = accs[0]
+          mean_acc_task_il = np.mean(task_accs,axis=1)
 
         if not args.debug_lpft and "tune" in os.environ["logging"]: 
           tune.report(class_il_mean_acc=mean_acc[0])
@@ -377,20 +581,36 @@ def trainable(config):
           print({'task_il_mean_acc': mean_acc_task_il[1]})
         # print_mean_accuracy(mean_acc, t + 1, dataset.SETTING)
 
+      profiler.end_epoch(t, epoch)
 
+
+    if lp_cache is not None:
+      lp_cache.close()
+
+    # charged to the first epoch of the next task in the profile
     if not args.train.save_best:
-      save_model(model,args,t,epoch,dataset)
-    
+      with profiler.phase('checkpoint'):
+        save_model(model,args,t,epoch,dataset)
+
 
     if not args.train.all_tasks_num_epochs or t == dataset.N_TASKS - 1:
       # always do a probe evaluate at end of task
-      probe_evaluate(args, t, dataset, model, device, memory_loader, all_probe_results, all_probe_train_results)
+      with profiler.phase('probe_monitor'):
+        probe_evaluate(args, t, dataset, model, device, memory_loader, all_probe_results, all_probe_train_results)
+
+    # after the probe, whose results of task t are part of the checkpoint
+    if scheduler and "tune" in os.environ["logging"]:
+      with profiler.phase('checkpoint'):
+        save_trial_checkpoint(model, t, head_bank, (all_task_results, all_probe_results, all_probe_train_results))
       
 
 
 
 
 
+  if not is_main_process():
+    return
+
   tune.report(done=1)
 
   if args.eval is not False and args.cl_default is False:
@@ -429,9 +649,18 @@ def train(args):
     "num_epochs": [0],
     # "proj_is_head": [False],
   }}
+  if getattr(args.train, 'scheduler', None):
+    # the scheduler needs the knn_monitor of the config
+    config['train'].pop('knn_monitor', None)
+  check_scheduler(args, config['train'])
     ## RAY TUNE
   # tune.run(trainable, config=config, num_samples=1, resources_per_trial={"cpu": 15, "gpu": 1})
-  if args.debug_lpft:
+  if init_distributed(args):
+    # torchrun: every process runs the grid in the same order, without tune
+    for train_config in ParameterGrid(config['train']):
+      trainable(config={**config, 'train': train_config})
+    cleanup_distributed()
+  elif args.debug_lpft:
     os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
     config['train'] = ParameterGrid(config['train'])[0]
     try:
@@ -440,7 +669,13 @@ def train(args):
       pdb.post_mortem()
   else:
     config['train'] = {k: tune.grid_search(v) for (k, v) in config['train'].items()}
-    tune.run(trainable, config=config, num_samples=1, resources_per_trial={"cpu":32, "gpu": 1})
+    # the splits are loaded once and put in the object store, whose (read-only,
+    # shared memory) copy every trial of the node uses
+    splits = load_shared_splits(args)
+    # fractional requests pack several small trials on one gpu
+    resources = {"cpu": getattr(args.train, 'trial_cpus', 32), "gpu": getattr(args.train, 'trial_gpus', 1)}
+    tune.run(tune.with_parameters(trainable, splits=splits), config=config, num_samples=1, resources_per_trial=resources,
+             scheduler=get_scheduler(args))
 
 
   
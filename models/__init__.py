@@ -1,24 +1,26 @@
-import os
-import importlib
+import torch
+from .utils.registry import MODELS, BACKBONES, register_model, register_backbone
+from .utils.registry import get_all_models, get_all_backbones, backbone_num_params
 from .simsiam import SimSiam
 from .barlowtwins import BarlowTwins
-from torchvision.models import resnet50, resnet18, resnet34, resnet101, resnet152
-import torch
-from types import FunctionType as ftype
 from .backbones import resnet18
+# importing the methods registers them in MODELS
+from . import finetune, der, mixup, si, agem, gem, gss, pnn
+
+
+# the backbones whose sizes get_model reports
+REPORTED_BACKBONES = ['resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152', 'densenet121', 'swav']
 
-swav = torch.hub.load('facebookresearch/swav:main', 'resnet50')
-densenet121 = torch.hub.load('pytorch/vision:v0.10.0', 'densenet121', pretrained=True)
 
 def get_head(backbone):
     if hasattr(backbone, "fc"):
-        return backbone.fc 
+        return backbone.fc
     else:
         return backbone.classifier
 
 def get_features(model, inputs):
     if hasattr(model, "embed"):
-        return model.embed(inputs)[0] 
+        return model.embed(inputs)[0]
     else:
         return model(inputs, return_features=True)
 
@@ -26,21 +28,12 @@ def get_num_params(model, is_trainable = None):
     """Get number of parameters of the model, specified by 'None': all parameters;
     True: trainable parameters; False: non-trainable parameters.
     """
-    num_params = 0
-    for param in list(model.parameters()):
-        nn=1
-        if is_trainable is None \
-            or (is_trainable is True and param.requires_grad is True) \
-            or (is_trainable is False and param.requires_grad is False):
-            for s in list(param.size()):
-                nn = nn * s
-            num_params += nn
-    return num_params
+    return sum(param.numel() for param in model.parameters()
+               if is_trainable is None or param.requires_grad == is_trainable)
 
 def get_backbone(backbone, dataset, castrate=True):
-    backbone = eval(f"{backbone}")
-    if type(backbone) == ftype:
-        backbone = backbone()
+    assert backbone in BACKBONES, f"unknown backbone {backbone}, choose from {get_all_backbones()}"
+    backbone = BACKBONES[backbone]()
     if dataset == 'seq-cifar100':
         backbone.n_classes = 100
     elif dataset == 'seq-cifar10':
@@ -53,29 +46,23 @@ def get_backbone(backbone, dataset, castrate=True):
     return backbone
 
 
-def get_all_models():
-    return [model.split('.')[0] for model in os.listdir('/sailhome/msun415/UCL/models')
-            if not model.find('__') > -1 and 'py' in model]
-
 def get_model(args, device, len_train_loader, transform):
     loss = torch.nn.CrossEntropyLoss()
+    fused = getattr(args.model, 'fused_views', False)
+    ghost_bn = getattr(args.model, 'ghost_bn', 1)
     if args.model.name == 'simsiam':
-        backbone =  SimSiam(get_backbone(args.model.backbone, args.dataset.name, args.cl_default)).to(device)
-        for class_ in [resnet18, resnet34, resnet50, resnet101, resnet152, densenet121, swav]:            
-            backbone_ = class_() if type(class_) == ftype else class_
-            print(f"{backbone_.__class__} has {get_num_params(backbone_)} params")
+        backbone =  SimSiam(get_backbone(args.model.backbone, args.dataset.name, args.cl_default), fused, ghost_bn).to(device)
+        # counted from the parameter shapes, once per process
+        for name in REPORTED_BACKBONES:
+            print(f"{name} has {backbone_num_params(name)} params")
         if args.model.proj_layers is not None:
             backbone.projector.set_layers(args.model.proj_layers)
     elif args.model.name == 'barlowtwins':
-        backbone = BarlowTwins(get_backbone(args.model.backbone, args.dataset.name, args.cl_default), device).to(device)
+        backbone = BarlowTwins(get_backbone(args.model.backbone, args.dataset.name, args.cl_default), device, fused, ghost_bn,
+                               getattr(args.model, 'loss_chunk_size', None)).to(device)
         if args.model.proj_layers is not None:
             backbone.projector.set_layers(args.model.proj_layers)
+    print(f"{args.model.backbone} has {get_num_params(backbone.backbone)} params")
 
-    names = {}
-    for model in get_all_models():
-        mod = importlib.import_module('models.' + model)
-        class_name = {x.lower():x for x in mod.__dir__()}[model.replace('_', '')]
-        names[model] = getattr(mod, class_name)
-    
-    return names[args.model.cl_model](backbone, loss, args, len_train_loader, transform)
-
+    assert args.model.cl_model in MODELS, f"unknown cl_model {args.model.cl_model}, choose from {get_all_models()}"
+    return MODELS[args.model.cl_model](backbone, loss, args, len_train_loader, transform)
@@ -1,9 +1,10 @@
 import torch
 import numpy as np
-from utils.buffer import Buffer
+from utils.buffer import get_buffer
 from models.gem import overwrite_grad
 from models.gem import store_grad
 from models.utils.continual_model import ContinualModel
+from models.utils.registry import register_model
 
 
 def project(gxy: torch.Tensor, ger: torch.Tensor) -> torch.Tensor:
@@ -11,6 +12,7 @@ def project(gxy: torch.Tensor, ger: torch.Tensor) -> torch.Tensor:
     return gxy - corr * ger
 
 
+@register_model
 class AGem(ContinualModel):
     NAME = 'agem'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il']
@@ -18,7 +20,7 @@ class AGem(ContinualModel):
     def __init__(self, backbone, loss, args, len_train_loader, transform):
         super(AGem, self).__init__(backbone, loss, args, len_train_loader, transform)
 
-        self.buffer = Buffer(self.args.model.buffer_size, self.device)
+        self.buffer = get_buffer(self.args.model.buffer_size, self.device)
         self.grad_dims = []
         for param in self.parameters():
             self.grad_dims.append(param.data.numel())
@@ -38,30 +40,38 @@ class AGem(ContinualModel):
 
         self.zero_grad()
         labels = labels.to(self.device)
-        p = self.net.module.backbone(inputs1.to(self.device))
-        loss = self.loss(p, labels)
-        loss.backward()
+        with self.autocast():
+            p = self.net(inputs1.to(self.device))
+            loss = self.loss(p, labels)
+        self.backward(loss)
         data_dict = {'loss': loss, 'penalty': 0}
 
         if not self.buffer.is_empty():
-            store_grad(self.parameters, self.grad_xy, self.grad_dims)
+            # both gradients carry the same loss scale and the projection is
+            # homogeneous in it, so the surgery runs on scaled gradients and
+            # optimizer_step unscales (and checks for overflow) as usual
+            with self.profiler.phase('grad_surgery'):
+                store_grad(self.parameters, self.grad_xy, self.grad_dims)
 
-            buf_inputs, buf_labels = self.buffer.get_data(self.args.train.batch_size, transform=self.transform)
+            with self.profiler.phase('buffer'):
+                buf_inputs, buf_labels = self.buffer.get_data(self.args.train.batch_size, transform=self.transform)
             self.net.zero_grad()
-            buf_outputs = self.net.module.backbone(buf_inputs)
-            penalty = self.loss(buf_outputs, buf_labels)
-            penalty.backward()
+            with self.autocast():
+                buf_outputs = self.net(buf_inputs)
+                penalty = self.loss(buf_outputs, buf_labels)
+            self.backward(penalty)
             data_dict['penalty'] = penalty
-            store_grad(self.parameters, self.grad_er, self.grad_dims)
+            with self.profiler.phase('grad_surgery'):
+                store_grad(self.parameters, self.grad_er, self.grad_dims)
 
-            dot_prod = torch.dot(self.grad_xy, self.grad_er)
-            if dot_prod.item() < 0:
-                g_tilde = project(gxy=self.grad_xy, ger=self.grad_er)
-                overwrite_grad(self.parameters, g_tilde, self.grad_dims)
-            else:
-                overwrite_grad(self.parameters, self.grad_xy, self.grad_dims)
+                dot_prod = torch.dot(self.grad_xy, self.grad_er)
+                if dot_prod.item() < 0:
+                    g_tilde = project(gxy=self.grad_xy, ger=self.grad_er)
+                    overwrite_grad(self.parameters, g_tilde, self.grad_dims)
+                else:
+                    overwrite_grad(self.parameters, self.grad_xy, self.grad_dims)
 
-        self.opt.step()
+        self.optimizer_step()
         data_dict.update({'lr': self.args.train.base_lr})
 
         return data_dict
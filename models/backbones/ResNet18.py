@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import os
+from ..utils.registry import register_backbone
 # https://raw.githubusercontent.com/huyvnphan/PyTorch_CIFAR10/master/cifar10_models/resnet.py
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
            'resnet152', 'resnext50_32x4d', 'resnext101_32x8d']
@@ -100,6 +101,8 @@ class Bottleneck(nn.Module):
 
 
 class ResNet(nn.Module):
+    # the modules embed runs in sequence, conv1 first
+    STAGES = ['conv1', 'bn1', 'layer1', 'layer2', 'layer3', 'layer4']
 
     def __init__(self, block, layers, num_classes=100, zero_init_residual=False,
                  groups=1, width_per_group=64, replace_stride_with_dilation=None,
@@ -121,6 +124,8 @@ class ResNet(nn.Module):
                              "or a 3-element tuple, got {}".format(replace_stride_with_dilation))
         self.groups = groups
         self.base_width = width_per_group
+        # number of leading STAGES that are frozen, see update_frozen_prefix
+        self.frozen_stages = 0
         
         ## CIFAR10: kernel_size 7 -> 3, stride 2 -> 1, padding 3->1
         self.conv1 = nn.Conv2d(3, self.inplanes, kernel_size=3, stride=1, padding=1, bias=False)
@@ -180,20 +185,41 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
     
-    def embed(self, x):
-        x1 = self.conv1(x)
-        x = self.bn1(x1)
-        x = self.relu(x)
-        # x = self.maxpool(x)
-
-        x2 = self.layer1(x)
-        x3 = self.layer2(x2)
-        x4 = self.layer3(x3)
-        x5 = self.layer4(x4)
+    def update_frozen_prefix(self) -> int:
+        """
+        Finds the leading STAGES whose parameters are all frozen. embed runs
+        them without autograd and their BatchNorms in eval mode, since
+        nothing before them is trained either.
+        :return: the number of frozen stages
+        """
+        self.frozen_stages = 0
+        for name in self.STAGES:
+            if any(p.requires_grad for p in getattr(self, name).parameters()):
+                break
+            self.frozen_stages += 1
+        return self.train(self.training).frozen_stages
+
+    def train(self, mode: bool=True):
+        super(ResNet, self).train(mode)
+        for name in self.STAGES[:self.frozen_stages]:
+            getattr(self, name).eval()
+        return self
 
-        x = self.avgpool(x5)
+    def embed(self, x):
+        features = []
+        grad = torch.is_grad_enabled()
+        for i, name in enumerate(self.STAGES):
+            with torch.set_grad_enabled(grad and i >= self.frozen_stages):
+                x = getattr(self, name)(x)
+                if name == 'bn1':
+                    x = self.relu(x)
+                    # x = self.maxpool(x)
+            if name != 'bn1':
+                features.append(x)
+
+        x = self.avgpool(x)
         x = x.reshape(x.size(0), -1)
-        return x, [x1, x2, x3, x4, x5]
+        return x, features
 
     def forward(self, x, return_features=False, plot_metrics=False):
         x, features_list = self.embed(x)
@@ -231,6 +257,7 @@ def _resnet(arch, block, layers, pretrained, progress, device, **kwargs):
     return model
 
 
+@register_backbone()
 def resnet18(pretrained=False, progress=True, device='cpu', **kwargs):
     """Constructs a ResNet-18 model.
 
@@ -1,8 +1,37 @@
+import torch
+import torchvision
+from ..utils.registry import register_backbone
 from .ResNet18 import resnet18 as resnet18
 from .ResNet18_PNN import resnet18_pnn as resnet18_pnn
 
 
+# resnet18 is the CIFAR variant registered in ResNet18.py, the deeper
+# resnets are the torchvision ImageNet models
+@register_backbone()
+def resnet34():
+    return torchvision.models.resnet34()
 
 
+@register_backbone()
+def resnet50():
+    return torchvision.models.resnet50()
 
 
+@register_backbone()
+def resnet101():
+    return torchvision.models.resnet101()
+
+
+@register_backbone()
+def resnet152():
+    return torchvision.models.resnet152()
+
+
+@register_backbone()
+def densenet121():
+    return torch.hub.load('pytorch/vision:v0.10.0', 'densenet121', pretrained=True)
+
+
+@register_backbone()
+def swav():
+    return torch.hub.load('facebookresearch/swav:main', 'resnet50')
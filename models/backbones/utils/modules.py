@@ -50,3 +50,64 @@ class ListModule(nn.Module):
 
     def __len__(self):
         return len(self._modules)
+
+
+class _SplitBatchNorm:
+    """
+    BatchNorm that, in training mode, normalizes consecutive chunks of the
+    batch (of sizes split_sizes) with their own statistics and updates the
+    running statistics once per chunk, exactly as if the chunks had been fed
+    in separate forward passes. split_sizes is set by bn_splits.
+    """
+    split_sizes = None
+
+    def forward(self, x):
+        if self.split_sizes is None or not self.training:
+            return super().forward(x)
+        return torch.cat([super(_SplitBatchNorm, self).forward(chunk)
+                          for chunk in x.split(self.split_sizes)])
+
+
+class SplitBatchNorm1d(_SplitBatchNorm, nn.BatchNorm1d):
+    pass
+
+
+class SplitBatchNorm2d(_SplitBatchNorm, nn.BatchNorm2d):
+    pass
+
+
+def convert_split_bn(module: nn.Module) -> nn.Module:
+    """
+    Replaces every BatchNorm1d/2d in module by its split version, sharing
+    the parameters and buffers of the original layer.
+    """
+    for name, child in module.named_children():
+        if type(child) in (nn.BatchNorm1d, nn.BatchNorm2d):
+            cls = SplitBatchNorm1d if isinstance(child, nn.BatchNorm1d) else SplitBatchNorm2d
+            split = cls(child.num_features, child.eps, child.momentum,
+                        child.affine, child.track_running_stats)
+            split.weight, split.bias = child.weight, child.bias
+            split.running_mean, split.running_var = child.running_mean, child.running_var
+            split.num_batches_tracked = child.num_batches_tracked
+            setattr(module, name, split)
+        else:
+            convert_split_bn(child)
+    return module
+
+
+class bn_splits:
+    """
+    Context manager setting the batch split of all the split BatchNorm
+    layers of module for the forward passes inside the block.
+    """
+    def __init__(self, module: nn.Module, split_sizes):
+        self.layers = [m for m in module.modules() if isinstance(m, _SplitBatchNorm)]
+        self.split_sizes = list(split_sizes)
+
+    def __enter__(self):
+        for m in self.layers:
+            m.split_sizes = self.split_sizes
+
+    def __exit__(self, *exc):
+        for m in self.layers:
+            m.split_sizes = None
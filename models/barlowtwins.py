@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F 
 from torchvision.models import resnet50
+from .backbones.utils.modules import convert_split_bn, bn_splits
+from .simsiam import view_splits, replay_forward
 
 
 def D(p, z, version='simplified'): # negative cosine similarity
@@ -87,34 +89,59 @@ class prediction_MLP(nn.Module):
         return x 
 
 
+def fp32(device):
+    # disables autocast inside the block
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, enabled=False)
+    return torch.cuda.amp.autocast(enabled=False)
+
+
 class BarlowTwinsLoss(torch.nn.Module):
 
-    def __init__(self, device, lambda_param=5e-3):
+    def __init__(self, device, lambda_param=5e-3, chunk_size=None):
         super(BarlowTwinsLoss, self).__init__()
         self.lambda_param = lambda_param
         self.device = device
+        # columns of the cross-correlation matrix built at a time when it
+        # has to be materialized (N >= D), None builds it in one go
+        self.chunk_size = chunk_size
 
-    def forward(self, z_a: torch.Tensor, z_b: torch.Tensor):
-        # normalize repr. along the batch dimension
-        z_a_norm = (z_a - z_a.mean(0)) / z_a.std(0) # NxD
-        z_b_norm = (z_b - z_b.mean(0)) / z_b.std(0) # NxD
-
-        N = z_a.size(0)
-        D = z_a.size(1)
+    def sum_squares(self, a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+        """
+        ||a^T b||_F^2 for a, b of shape NxD, without the DxD product when
+        the batch is smaller than the projector width:
+        ||a^T b||_F^2 = sum((a a^T) * (b b^T)), two NxN Gram matrices.
+        """
+        N, D = a.shape
+        if N < D:
+            return (torch.mm(a, a.T) * torch.mm(b, b.T)).sum()
+        if self.chunk_size is None:
+            return torch.mm(a.T, b).pow(2).sum()
+        return sum(torch.mm(a.T, b_chunk).pow(2).sum() for b_chunk in b.split(self.chunk_size, dim=1))
 
-        # cross-correlation matrix
-        c = torch.mm(z_a_norm.T, z_b_norm) / N # DxD
-        # loss
-        c_diff = (c - torch.eye(D,device=self.device)).pow(2) # DxD
-        # multiply off-diagonal elems of c_diff by lambda
-        c_diff[~torch.eye(D, dtype=bool)] *= self.lambda_param
-        loss = c_diff.sum()
+    def forward(self, z_a: torch.Tensor, z_b: torch.Tensor):
+        # the batch standardization and the DxD sum of squares overflow or
+        # lose too much precision in fp16/bf16, compute the loss in fp32
+        with fp32(z_a.device):
+            z_a, z_b = z_a.float(), z_b.float()
+            # normalize repr. along the batch dimension
+            z_a_norm = (z_a - z_a.mean(0)) / z_a.std(0) # NxD
+            z_b_norm = (z_b - z_b.mean(0)) / z_b.std(0) # NxD
+
+            N = z_a.size(0)
+
+            # c = z_a_norm^T z_b_norm / N is never built:
+            # sum_i (c_ii - 1)^2 + lambda * (||c||_F^2 - sum_i c_ii^2)
+            c_diag = (z_a_norm * z_b_norm).sum(0) / N # D
+            on_diag = (c_diag - 1).pow(2).sum()
+            off_diag = self.sum_squares(z_a_norm, z_b_norm) / N ** 2 - c_diag.pow(2).sum()
+            loss = on_diag + self.lambda_param * off_diag
 
         return loss
 
 
 class BarlowTwins(nn.Module):
-    def __init__(self, backbone, device):
+    def __init__(self, backbone, device, fused=False, ghost_bn=1, loss_chunk_size=None):
         super().__init__()
         
         self.backbone = backbone
@@ -125,34 +152,79 @@ class BarlowTwins(nn.Module):
             self.projector
         )
         self.predictor = prediction_MLP()
-        self.criterion = BarlowTwinsLoss(device=device)
-    
-    def forward(self, x1, x2):
+        self.criterion = BarlowTwinsLoss(device=device, chunk_size=loss_chunk_size)
 
-        f, h = self.encoder, self.predictor
-        z1, z2 = f(x1), f(x2)
-        p1, p2 = h(z1), h(z2)
+        # see SimSiam
+        self.fused = fused
+        self.ghost_bn = ghost_bn
+        if fused:
+            convert_split_bn(self)
+    
+    def forward(self, x1, x2=None, features=False, replay=None):
+        # features: x1 and x2 are backbone features (see FeatureCache), only the heads run
+        # replay: inputs that only go through the backbone, in the same pass as the views (see Der);
+        # their outputs are returned as 'replay', with the backbone 'features' of x1
+        # a single input is a supervised forward of the backbone (cl_default)
+        if x2 is None:
+            if features:
+                return (self.backbone.fc if hasattr(self.backbone, 'fc') else self.backbone.classifier)(x1)
+            return self.backbone(x1)
+        if replay is not None:
+            x1, x2, replay = replay_forward(self.backbone, x1, x2, replay, self.ghost_bn if self.fused else 1)
+            features = True
+
+        f, h = self.projector if features else self.encoder, self.predictor
+        if self.fused:
+            with bn_splits(self, view_splits(x1.shape[0], 2, self.ghost_bn)):
+                z1, z2 = f(torch.cat([x1, x2])).split(x1.shape[0])
+                p1, p2 = h(torch.cat([z1, z2])).split(x1.shape[0])
+        else:
+            z1, z2 = f(x1), f(x2)
+            p1, p2 = h(z1), h(z2)
         L = self.criterion(z1, z2)
+        if replay is not None:
+            return {'loss': L, 'features': x1, 'replay': replay}
         return {'loss': L}
 
 if __name__ == "__main__":
-    model = SimSiam()
-    model = torch.nn.DataParallel(model).cuda()
-    x1 = torch.randn((128, 3, 32, 32))
-    x2 = torch.randn_like(x1)
-
-    for i in range(50):
-        model.forward(x1, x2).backward()
-    print("forward backwork check")
-
-    z1 = torch.randn((200, 2560))
-    z2 = torch.randn_like(z1)
     import time
-    tic = time.time()
-    print(D(z1, z2, version='original'))
-    toc = time.time()
-    print(toc - tic)
-    tic = time.time()
-    print(D(z1, z2, version='simplified'))
-    toc = time.time()
 
+    def reference_loss(z_a, z_b, lambda_param=5e-3):
+        # the DxD formulation the loss above replaces
+        z_a_norm = (z_a - z_a.mean(0)) / z_a.std(0)
+        z_b_norm = (z_b - z_b.mean(0)) / z_b.std(0)
+        N, D = z_a.shape
+        c = torch.mm(z_a_norm.T, z_b_norm) / N
+        c_diff = (c - torch.eye(D, device=z_a.device)).pow(2)
+        c_diff[~torch.eye(D, dtype=bool, device=z_a.device)] *= lambda_param
+        return c_diff.sum()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    for N, D, chunk_size in [(256, 2048, None), (4096, 2048, None), (4096, 2048, 512)]:
+        criterion = BarlowTwinsLoss(device, chunk_size=chunk_size)
+        z_a = torch.randn(N, D, device=device)
+        z_b = z_a + 0.5 * torch.randn_like(z_a)
+        print(f"N={N} D={D} chunk_size={chunk_size}")
+        for name, loss_fn in [('reference', reference_loss), ('rewritten', criterion)]:
+            z_a.grad = None
+            z_a.requires_grad_(True)
+            loss_fn(z_a, z_b).backward() # warmup
+            if device.type == 'cuda': torch.cuda.synchronize()
+            tic = time.time()
+            for _ in range(10):
+                loss = loss_fn(z_a, z_b)
+                loss.backward()
+            if device.type == 'cuda': torch.cuda.synchronize()
+            toc = time.time()
+            print(f"  {name}: loss {loss.item():.4f}, {(toc - tic) / 10 * 1000:.2f} ms (fwd+bwd)")
+
+# Output (cpu, 1 thread):
+# N=256 D=2048 chunk_size=None
+#   reference: loss 106.5324, 391.81 ms (fwd+bwd)
+#   rewritten: loss 106.5324, 21.24 ms (fwd+bwd)
+# N=4096 D=2048 chunk_size=None
+#   reference: loss 28.0561, 1437.99 ms (fwd+bwd)
+#   rewritten: loss 28.0561, 1109.95 ms (fwd+bwd)
+# N=4096 D=2048 chunk_size=512
+#   reference: loss 28.0063, 1379.39 ms (fwd+bwd)
+#   rewritten: loss 28.0063, 1014.39 ms (fwd+bwd)
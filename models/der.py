@@ -1,41 +1,63 @@
-from utils.buffer import Buffer
+import torch
+from utils.buffer import get_buffer
 from torch.nn import functional as F
 from models.utils.continual_model import ContinualModel
+from models.backbones.utils.modules import convert_split_bn, bn_splits
+from models.utils.registry import register_model
 from augmentations import get_aug
 
+@register_model
 class Der(ContinualModel):
     NAME = 'der'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il', 'general-continual']
 
     def __init__(self, backbone, loss, args, len_train_loader, transform):
+        # the current and buffer batches go through the backbone as one batch,
+        # with the BatchNorm statistics of each computed separately
+        convert_split_bn(backbone.backbone)
         super(Der, self).__init__(backbone, loss, args, len_train_loader, transform)
-        self.buffer = Buffer(self.args.model.buffer_size, self.device)
+        self.buffer = get_buffer(self.args.model.buffer_size, self.device)
 
     def observe(self, inputs1, labels, inputs2, notaug_inputs):
 
         self.opt.zero_grad()
-        if self.args.cl_default:
-            labels = labels.to(self.device)
-            outputs = self.net.module.backbone(inputs1.to(self.device))
-            loss = self.loss(outputs, labels).mean()
-            data_dict = {'loss': loss, 'penalty': 0}
+        inputs1 = inputs1.to(self.device, non_blocking=True)
+        if self.buffer.is_empty():
+            buf_inputs = buf_logits = None
         else:
-            data_dict = self.net.forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
-            loss = data_dict['loss'].mean()
-            data_dict['loss'] = data_dict['loss'].mean()
-            outputs = self.net.module.backbone(inputs1.to(self.device))
-            data_dict['penalty'] = 0
+            with self.profiler.phase('buffer'):
+                buf_inputs, buf_logits = self.buffer.get_data(
+                    self.args.train.batch_size, transform=self.transform)
+        with self.autocast():
+            if self.args.cl_default:
+                labels = labels.to(self.device)
+                n = len(inputs1)
+                if buf_inputs is None:
+                    outputs = self.net(inputs1)
+                else:
+                    with bn_splits(self.net.module.backbone, [n, len(buf_inputs)]):
+                        outputs = self.net(torch.cat([inputs1, buf_inputs]))
+                outputs, buf_outputs = outputs[:n], outputs[n:]
+                loss = self.loss(outputs, labels).mean()
+                data_dict = {'loss': loss, 'penalty': 0}
+            else:
+                # the backbone outputs of inputs1 (the logits to store) and of
+                # the buffer come from the backbone pass of the SSL forward
+                replay = inputs1[:0] if buf_inputs is None else buf_inputs
+                data_dict = self.net(inputs1, inputs2.to(self.device, non_blocking=True), replay=replay)
+                outputs, buf_outputs = data_dict.pop('features'), data_dict.pop('replay')
+                loss = data_dict['loss'].mean()
+                data_dict['loss'] = data_dict['loss'].mean()
+                data_dict['penalty'] = 0
 
-        if not self.buffer.is_empty():
-            buf_inputs, buf_logits = self.buffer.get_data(
-                self.args.train.batch_size, transform=self.transform)
-            buf_outputs = self.net.module.backbone(buf_inputs)
-            data_dict['penalty'] = self.args.train.alpha * F.mse_loss(buf_outputs, buf_logits)
-            loss += data_dict['penalty']
+            if buf_inputs is not None:
+                data_dict['penalty'] = self.args.train.alpha * F.mse_loss(buf_outputs, buf_logits)
+                loss += data_dict['penalty']
 
-        loss.backward()
-        self.opt.step()
+        self.backward(loss)
+        self.optimizer_step()
         data_dict.update({'lr': self.args.train.base_lr})
-        self.buffer.add_data(examples=notaug_inputs, logits=outputs.data)
+        with self.profiler.phase('buffer'):
+            self.buffer.add_data(examples=notaug_inputs, logits=outputs.data)
 
         return data_dict
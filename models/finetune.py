@@ -1,8 +1,10 @@
 from utils.buffer import Buffer
 from torch.nn import functional as F
 from models.utils.continual_model import ContinualModel
+from models.utils.registry import register_model
 from augmentations import get_aug
 
+@register_model
 class Finetune(ContinualModel):
     NAME = 'finetune'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il', 'general-continual']
@@ -12,20 +14,43 @@ class Finetune(ContinualModel):
 
     def observe(self, inputs1, labels, inputs2, notaug_inputs):
         self.opt.zero_grad()
-        if self.args.cl_default:
-            labels = labels.to(self.device)
-            outputs = self.net.backbone(inputs1.to(self.device))
-            loss = self.loss(outputs, labels).mean()
-            data_dict = {'loss': loss}
-            data_dict['penalty'] = 0.0            
-        else:
-            data_dict = self.net.forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
-            data_dict['loss'] = data_dict['loss'].mean()
-            loss = data_dict['loss']
-            data_dict['penalty'] = 0.0
+        with self.autocast():
+            if self.args.cl_default:
+                labels = labels.to(self.device)
+                outputs = self.net(inputs1.to(self.device))
+                loss = self.loss(outputs, labels).mean()
+                data_dict = {'loss': loss}
+                data_dict['penalty'] = 0.0            
+            else:
+                data_dict = self.ssl_forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
+                data_dict['loss'] = data_dict['loss'].mean()
+                loss = data_dict['loss']
+                data_dict['penalty'] = 0.0
 
-        loss.backward()
-        self.opt.step()
+        self.backward(loss)
+        self.optimizer_step()
         # data_dict.update({'lr': self.args.train.base_lr})
 
         return data_dict
+
+    def observe_features(self, features1, labels, features2):
+        """
+        Step of observe on the backbone features of the inputs (a FeatureCache
+        of the frozen backbone), which only trains the heads.
+        """
+        self.opt.zero_grad()
+        with self.autocast():
+            if self.args.cl_default:
+                outputs = self.net(features1, features=True)
+                loss = self.loss(outputs, labels).mean()
+                data_dict = {'loss': loss}
+            else:
+                data_dict = self.net(features1, features2, features=True)
+                data_dict['loss'] = data_dict['loss'].mean()
+                loss = data_dict['loss']
+            data_dict['penalty'] = 0.0
+
+        self.backward(loss)
+        self.optimizer_step()
+
+        return data_dict
@@ -8,9 +8,11 @@ import quadprog
 
 import numpy as np
 import torch
-from models.utils.continual_model import ContinualModel
+from models.utils.continual_model import ContinualModel, to_device
+from models.utils.registry import register_model
 
 from utils.buffer import Buffer
+from utils.distributed import is_distributed
 
 
 def store_grad(params, grads, grad_dims):
@@ -73,12 +75,16 @@ def project2cone2(gradient, memories, margin=0.5, eps=1e-3):
     gradient.copy_(torch.from_numpy(x).view(-1, 1))
 
 
+@register_model
 class Gem(ContinualModel):
     NAME = 'gem'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il']
 
     def __init__(self, backbone, loss, args, transform):
         super(Gem, self).__init__(backbone, loss, args, transform)
+        # the buffer gradients and the QP projection are computed by each process
+        # on its own, which would make the replicas diverge
+        assert not is_distributed(), "gem does not support distributed training"
         self.current_task = 0
         self.buffer = Buffer(self.args.buffer_size, self.device)
 
@@ -90,6 +96,16 @@ class Gem(ContinualModel):
         self.grads_cs = []
         self.grads_da = torch.zeros(np.sum(self.grad_dims)).to(self.device)
 
+    def method_state(self):
+        state = super(Gem, self).method_state()
+        state.update(current_task=self.current_task, grads_cs=self.grads_cs)
+        return state
+
+    def load_method_state(self, state):
+        super(Gem, self).load_method_state(state)
+        self.current_task = state['current_task']
+        self.grads_cs = [to_device(grads, self.device) for grads in state['grads_cs']]
+
     def end_task(self, dataset):
         self.current_task += 1
         self.grads_cs.append(torch.zeros(
@@ -110,40 +126,48 @@ class Gem(ContinualModel):
     def observe(self, inputs, labels, not_aug_inputs):
 
         if not self.buffer.is_empty():
-            buf_inputs, buf_labels, buf_task_labels = self.buffer.get_data(
-                self.args.buffer_size, transform=self.transform)
+            with self.profiler.phase('buffer'):
+                buf_inputs, buf_labels, buf_task_labels = self.buffer.get_data(
+                    self.args.buffer_size, transform=self.transform)
 
             for tt in buf_task_labels.unique():
                 # compute gradient on the memory buffer
                 self.opt.zero_grad()
                 cur_task_inputs = buf_inputs[buf_task_labels == tt]
                 cur_task_labels = buf_labels[buf_task_labels == tt]
-                cur_task_outputs = self.forward(cur_task_inputs)
-                penalty = self.loss(cur_task_outputs, cur_task_labels)
-                penalty.backward()
-                store_grad(self.parameters, self.grads_cs[tt], self.grad_dims)
+                with self.autocast():
+                    cur_task_outputs = self.forward(cur_task_inputs)
+                    penalty = self.loss(cur_task_outputs, cur_task_labels)
+                self.backward(penalty)
+                with self.profiler.phase('grad_surgery'):
+                    store_grad(self.parameters, self.grads_cs[tt], self.grad_dims)
+                    # the QP margin is not scale invariant, store true gradients
+                    self.grads_cs[tt].div_(self.grad_scale())
 
         # now compute the grad on the current data
         self.opt.zero_grad()
-        outputs = self.forward(inputs)
-        loss = self.loss(outputs, labels)
-        loss.backward()
+        with self.autocast():
+            outputs = self.net(inputs)
+            loss = self.loss(outputs, labels)
+        self.backward(loss)
 
         # check if gradient violates buffer constraints
         if not self.buffer.is_empty():
-            # copy gradient
-            store_grad(self.parameters, self.grads_da, self.grad_dims)
-
-            dot_prod = torch.mm(self.grads_da.unsqueeze(0),
-                            torch.stack(self.grads_cs).T)
-            if (dot_prod < 0).sum() != 0:
-                project2cone2(self.grads_da.unsqueeze(1),
-                              torch.stack(self.grads_cs).T, margin=self.args.gamma)
-                # copy gradients back
-                overwrite_grad(self.parameters, self.grads_da,
-                               self.grad_dims)
-
-        self.opt.step()
+            with self.profiler.phase('grad_surgery'):
+                self.unscale_grads()
+                # copy gradient
+                store_grad(self.parameters, self.grads_da, self.grad_dims)
+
+                dot_prod = torch.mm(self.grads_da.unsqueeze(0),
+                                torch.stack(self.grads_cs).T)
+                if (dot_prod < 0).sum() != 0:
+                    project2cone2(self.grads_da.unsqueeze(1),
+                                  torch.stack(self.grads_cs).T, margin=self.args.gamma)
+                    # copy gradients back
+                    overwrite_grad(self.parameters, self.grads_da,
+                                   self.grad_dims)
+
+        self.optimizer_step()
 
         return loss.item()
 
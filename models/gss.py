@@ -2,6 +2,7 @@ import torch
 from utils.gss_buffer import Buffer as Buffer
 from utils.args import *
 from models.utils.continual_model import ContinualModel
+from models.utils.registry import register_model
 
 
 def get_parser() -> ArgumentParser:
@@ -17,6 +18,7 @@ def get_parser() -> ArgumentParser:
     return parser
 
 
+@register_model
 class Gss(ContinualModel):
     NAME = 'gss'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il', 'general-continual']
@@ -51,21 +53,24 @@ class Gss(ContinualModel):
         for _ in range(self.alj_nepochs):
             self.opt.zero_grad()
             if not self.buffer.is_empty():
-                buf_inputs, buf_labels = self.buffer.get_data(
-                    self.args.train.batch_size, transform=self.transform)
+                with self.profiler.phase('buffer'):
+                    buf_inputs, buf_labels = self.buffer.get_data(
+                        self.args.train.batch_size, transform=self.transform)
                 tinputs = torch.cat((inputs1.to(self.device), buf_inputs))
                 tlabels = torch.cat((labels, buf_labels))
             else:
                 tinputs = inputs1.to(self.device)
                 tlabels = labels
 
-            outputs = self.net.module.backbone(tinputs)
-            loss = self.loss(outputs, tlabels)
-            loss.backward()
-            self.opt.step()
+            with self.autocast():
+                outputs = self.net(tinputs)
+                loss = self.loss(outputs, tlabels)
+            self.backward(loss)
+            self.optimizer_step()
 
-        self.buffer.add_data(examples=notaug_inputs,
-                             labels=labels[:real_batch_size])
+        with self.profiler.phase('buffer'):
+            self.buffer.add_data(examples=notaug_inputs,
+                                 labels=labels[:real_batch_size])
         data_dict = {'loss': loss, 'penalty': 0}
         data_dict.update({'lr': self.args.train.base_lr})
 
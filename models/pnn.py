@@ -8,9 +8,11 @@ from torch.optim import SGD
 import torch
 import torch.nn as nn
 from utils.conf import get_device
+from utils.distributed import get_world_size
 from utils.args import *
 from datasets import get_dataset
 from .utils.continual_model import ContinualModel
+from .utils.registry import register_model
 from .optimizers import get_optimizer, LR_Scheduler
 
 
@@ -30,8 +32,11 @@ def get_backbone(bone, old_cols=None, x_shape=None):
     return resnet18_pnn(bone.n_classes, bone.inplanes, old_cols, x_shape)
 
 
+@register_model
 class Pnn(ContinualModel):
     NAME = 'pnn'
+    # the columns and the optimizer are rebuilt at each task, outside method_state
+    RESUMABLE = False
     COMPATIBILITY = ['task-il']
 
     def __init__(self, backbone, loss, args, len_train_lodaer, transform):
@@ -72,7 +77,7 @@ class Pnn(ContinualModel):
         self.net = self.nets[-1]
         self.opt = get_optimizer(
             self.args.train.optimizer.name, self.net, 
-            lr=self.args.train.base_lr*self.args.train.batch_size/256, 
+            lr=self.args.train.base_lr*self.args.train.batch_size*get_world_size()/256, 
             momentum=self.args.train.optimizer.momentum,
             weight_decay=self.args.train.optimizer.weight_decay)
         
@@ -81,17 +86,18 @@ class Pnn(ContinualModel):
             self.x_shape = inputs1.shape
 
         self.opt.zero_grad()
-        if self.args.cl_default:
-            outputs = self.net.module.backbone(inputs1)
-            loss = self.loss(outputs, labels)
-            data_dict = {'loss': loss, 'penalty': 0.0}
-        else:
-            data_dict = self.net.forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
-            data_dict['loss'] = data_dict['loss'][0].mean()
-            data_dict['penalty'] = 0.0
-            loss = data_dict['loss']
-        loss.backward()
-        self.opt.step()
+        with self.autocast():
+            if self.args.cl_default:
+                outputs = self.net(inputs1)
+                loss = self.loss(outputs, labels)
+                data_dict = {'loss': loss, 'penalty': 0.0}
+            else:
+                data_dict = self.ssl_forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
+                data_dict['loss'] = data_dict['loss'][0].mean()
+                data_dict['penalty'] = 0.0
+                loss = data_dict['loss']
+        self.backward(loss)
+        self.optimizer_step()
         data_dict.update({'lr': self.args.train.base_lr})
 
         return data_dict
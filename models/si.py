@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
 from utils.args import *
-from .utils.continual_model import ContinualModel
+from .utils.continual_model import ContinualModel, to_device
+from .utils.registry import register_model
 
 
+@register_model
 class SI(ContinualModel):
     NAME = 'si'
     COMPATIBILITY = ['class-il', 'domain-il', 'task-il']
@@ -17,6 +19,17 @@ class SI(ContinualModel):
         self.c = args.train.alpha
         self.xi = 1.0
 
+    def method_state(self):
+        state = super(SI, self).method_state()
+        state.update(checkpoint=self.checkpoint, big_omega=self.big_omega, small_omega=self.small_omega)
+        return state
+
+    def load_method_state(self, state):
+        super(SI, self).load_method_state(state)
+        self.checkpoint = to_device(state['checkpoint'], self.device)
+        self.big_omega = to_device(state['big_omega'], self.device)
+        self.small_omega = to_device(state['small_omega'], self.device)
+
     def penalty(self):
         if self.big_omega is None:
             return torch.tensor(0.0).to(self.device)
@@ -36,21 +49,25 @@ class SI(ContinualModel):
 
     def observe(self, inputs1, labels, inputs2, notaug_inputs):
         self.opt.zero_grad()
-        if self.args.cl_default:
-            labels = labels.to(self.device)
-            outputs = self.net.module.backbone(inputs1.to(self.device))
-            penalty = self.c * self.penalty()
-            loss = self.loss(outputs, labels).mean() + penalty
-            data_dict = {'loss': loss, 'penalty': -penalty}
-        else:
-            data_dict = self.net.forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
-            data_dict['penalty'] = self.c * self.penalty() 
-            data_dict['loss'] = data_dict['loss'].mean()
-            loss = data_dict['loss'] + data_dict['penalty']
+        with self.autocast():
+            if self.args.cl_default:
+                labels = labels.to(self.device)
+                outputs = self.net(inputs1.to(self.device))
+                penalty = self.c * self.penalty()
+                loss = self.loss(outputs, labels).mean() + penalty
+                data_dict = {'loss': loss, 'penalty': -penalty}
+            else:
+                data_dict = self.ssl_forward(inputs1.to(self.device, non_blocking=True), inputs2.to(self.device, non_blocking=True))
+                data_dict['penalty'] = self.c * self.penalty() 
+                data_dict['loss'] = data_dict['loss'].mean()
+                loss = data_dict['loss'] + data_dict['penalty']
             
-        loss.backward()
-        nn.utils.clip_grad.clip_grad_value_(self.net.parameters(), 1)
-        self.opt.step()
+        self.backward(loss)
+        # clipping and small_omega need the true gradients
+        with self.profiler.phase('grad_surgery'):
+            self.unscale_grads()
+            nn.utils.clip_grad.clip_grad_value_(self.net.parameters(), 1)
+        self.optimizer_step()
         data_dict.update({'lr': self.args.train.base_lr})
 
         self.small_omega += self.args.train.base_lr * self.net.module.backbone.get_grads().data ** 2
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F 
 from torchvision.models import resnet18, resnet34, resnet50, resnet101, resnet152 
+from .backbones.utils.modules import convert_split_bn, bn_splits
 
 
 def D(p, z, version='simplified'): # negative cosine similarity
@@ -86,8 +87,30 @@ class prediction_MLP(nn.Module):
         x = self.layer2(x)
         return x 
 
+def view_splits(batch_size, num_views, ghost_bn=1):
+    """
+    BatchNorm split sizes for num_views views of batch_size samples fed as a
+    single batch: one split per view, or ghost_bn ghost batches per view.
+    """
+    ghost = [batch_size // ghost_bn + (i < batch_size % ghost_bn) for i in range(ghost_bn)]
+    return [size for size in ghost if size] * num_views
+
+
+def replay_forward(backbone, x1, x2, replay, ghost_bn=1):
+    """
+    Backbone outputs of the two views and of replay (e.g. samples of a
+    rehearsal buffer, possibly none) from a single pass over the concatenated
+    batch. The BatchNorm layers of backbone must be split (convert_split_bn):
+    statistics are computed per view (or ghost batch) and over replay, as in
+    separate passes.
+    """
+    n, m = x1.shape[0], replay.shape[0]
+    with bn_splits(backbone, view_splits(n, 2, ghost_bn) + ([m] if m else [])):
+        return backbone(torch.cat([x1, x2, replay])).split([n, n, m])
+
+
 class SimSiam(nn.Module):
-    def __init__(self, backbone=resnet50()):
+    def __init__(self, backbone=resnet50(), fused=False, ghost_bn=1):
         super().__init__()                
 
         self.backbone = backbone
@@ -98,13 +121,38 @@ class SimSiam(nn.Module):
             self.projector
         )
         self.predictor = prediction_MLP()
-    
-    def forward(self, x1, x2):
 
-        f, h = self.encoder, self.predictor
-        z1, z2 = f(x1), f(x2)
-        p1, p2 = h(z1), h(z2)
+        # fused: both views go through the networks as one batch, with
+        # BatchNorm statistics still computed per view (or per ghost batch)
+        self.fused = fused
+        self.ghost_bn = ghost_bn
+        if fused:
+            convert_split_bn(self)
+    
+    def forward(self, x1, x2=None, features=False, replay=None):
+        # features: x1 and x2 are backbone features (see FeatureCache), only the heads run
+        # replay: inputs that only go through the backbone, in the same pass as the views (see Der);
+        # their outputs are returned as 'replay', with the backbone 'features' of x1
+        # a single input is a supervised forward of the backbone (cl_default)
+        if x2 is None:
+            if features:
+                return (self.backbone.fc if hasattr(self.backbone, 'fc') else self.backbone.classifier)(x1)
+            return self.backbone(x1)
+        if replay is not None:
+            x1, x2, replay = replay_forward(self.backbone, x1, x2, replay, self.ghost_bn if self.fused else 1)
+            features = True
+
+        f, h = self.projector if features else self.encoder, self.predictor
+        if self.fused:
+            with bn_splits(self, view_splits(x1.shape[0], 2, self.ghost_bn)):
+                z1, z2 = f(torch.cat([x1, x2])).split(x1.shape[0])
+                p1, p2 = h(torch.cat([z1, z2])).split(x1.shape[0])
+        else:
+            z1, z2 = f(x1), f(x2)
+            p1, p2 = h(z1), h(z2)
         L = D(p1, z2) / 2 + D(p2, z1) / 2
+        if replay is not None:
+            return {'loss': L, 'features': x1, 'replay': replay}
         return {'loss': L}
 
 if __name__ == "__main__":
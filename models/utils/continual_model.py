@@ -10,29 +10,48 @@ import torchvision
 from argparse import Namespace
 from utils.conf import get_device
 import numpy as np
+from contextlib import nullcontext, contextmanager
+from utils.profiler import NullProfiler
+from utils.distributed import is_distributed, get_world_size, wrap_net, convert_sync_bn
+from utils.buffer import Buffer
 from ..optimizers import get_optimizer, LR_Scheduler
 
 
+def to_device(value, device):
+    # tensors of a checkpoint to device, anything else as is
+    return value.to(device) if isinstance(value, torch.Tensor) else value
+
+
 class ContinualModel(nn.Module):
     """
     Continual learning model.
     """
     NAME = None
     COMPATIBILITY = []
+    # whether method_state holds all the state of the method, so that a trial can be resumed
+    RESUMABLE = True
 
     def __init__(self, backbone: nn.Module, loss: nn.Module,
             args: Namespace, len_train_lodaer, transform: torchvision.transforms) -> None:
         super(ContinualModel, self).__init__()
 
-        self.net = backbone
-        # self.net = nn.DataParallel(self.net)
+        self.device = get_device()
+        # SyncBN is only meaningful (and only converted) in a distributed run
+        if getattr(args.model, 'sync_bn', False) and is_distributed():
+            assert not getattr(args.model, 'fused_views', False), "sync_bn and fused_views are exclusive"
+            assert self.device.type == 'cuda', "sync_bn needs cuda devices"
+            convert_sync_bn(backbone)
+        # DistributedDataParallel under torchrun, a plain wrapper otherwise:
+        # the SSL network is self.net.module in both cases
+        self.net = wrap_net(backbone, self.device, find_unused_parameters=self.has_unused_parameters(args))
         self.loss = loss
         self.args = args
         self.transform = transform
         
+        # batch_size is per process, the lr follows the batch of all the processes
         self.opt = get_optimizer(
             args.train.optimizer.name, self.net, 
-            lr=args.train.lp_lr*args.train.batch_size/256, 
+            lr=args.train.lp_lr*args.train.batch_size*get_world_size()/256, 
             momentum=args.train.optimizer.momentum,
             weight_decay=args.train.optimizer.weight_decay)
         
@@ -43,7 +62,196 @@ class ContinualModel(nn.Module):
         #     len_train_lodaer,
         #     constant_predictor_lr=True # see the end of section 4.2 predictor
         # )
-        self.device = get_device()
+
+        # mixed precision: False (fp32), 'fp16' (with loss scaling) or 'bf16'
+        self.amp = getattr(args.train, 'amp', False) or False
+        assert self.amp in [False, 'fp16', 'bf16'], f"unknown amp mode {self.amp}"
+        assert self.amp != 'fp16' or self.device.type == 'cuda', "fp16 training needs a cuda device"
+        assert self.amp != 'bf16' or hasattr(torch, 'autocast'), "bf16 training needs torch>=1.10"
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(self.amp)
+        # a disabled scaler passes losses and optimizer steps through unchanged
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=self.amp == 'fp16')
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp == 'fp16')
+
+        # opt-in torch.compile of the two-view SSL step; on cuda the graph is
+        # replayed as a CUDA graph ('reduce-overhead'), which removes the
+        # kernel launch overhead that dominates small (CIFAR sized) inputs
+        self.compile = getattr(args.train, 'compile', False) or False
+        assert not self.compile or hasattr(torch, 'compile'), "train.compile needs torch>=2.0"
+        self.compiled_net = None
+        self.compiled_shape = None
+        self.compiled_opt = None
+        self.compiled_opt_step = None
+
+        # (optimizer, full param groups, state of the dropped params), see update_frozen_params
+        self.opt_params = None
+
+        # utils.gradient.GradStatsCollector updated after every optimizer step, set by LP-FT (main.freeze_weights)
+        self.grad_stats = None
+
+        # phase timings, replaced by a utils.profiler.StepProfiler with train.profile
+        self.profiler = NullProfiler()
+
+    def has_unused_parameters(self, args: Namespace) -> bool:
+        """
+        Whether some training steps leave parameters of the network without
+        gradient, which DistributedDataParallel then looks for in every step:
+        the supervised forward (projector and predictor), LP-FT (frozen
+        parameters, heads trained from cached features), 2-layer projectors
+        and BarlowTwins' predictor. Otherwise the search is skipped.
+        """
+        return bool(args.cl_default or getattr(args, 'lpft', False) or args.model.name == 'barlowtwins'
+                    or getattr(args.model, 'proj_layers', None) == 2)
+
+    @contextmanager
+    def autocast(self):
+        """
+        Context manager under which the forward pass and the loss are computed
+        (the 'forward' phase of the profiler).
+        """
+        with self.profiler.phase('forward'), self._autocast():
+            yield
+
+    def _autocast(self):
+        if not self.amp:
+            return nullcontext()
+        if not hasattr(torch, 'autocast'):
+            return torch.cuda.amp.autocast()
+        return torch.autocast(self.device.type, dtype=self.amp_dtype)
+
+    @torch.no_grad()
+    def embed(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Backbone features of x, in fp32, computed without autograd in the
+        precision of training (amp).
+        """
+        backbone = self.net.module.backbone
+        with self._autocast():
+            features = backbone.embed(x)[0] if hasattr(backbone, 'embed') else backbone(x, return_features=True)
+        return features.float()
+
+    def backward(self, loss: torch.Tensor) -> None:
+        """
+        Backpropagates the (scaled, in fp16 mode) loss.
+        """
+        with self.profiler.phase('backward'):
+            self.scaler.scale(loss).backward()
+
+    def unscale_grads(self) -> None:
+        """
+        Divides .grad by the loss scale. Must be called before gradients are
+        read or modified (clipping, projections, importance estimates), and
+        at most once between backward() and optimizer_step().
+        """
+        self.scaler.unscale_(self.opt)
+
+    def grad_scale(self) -> float:
+        """
+        Current loss scale, for gradients that are read before unscale_grads
+        (e.g. several backward passes in the same step).
+        """
+        return self.scaler.get_scale() if self.scaler.is_enabled() else 1.
+
+    def optimizer_step(self) -> None:
+        """
+        Steps the optimizer, skipping the update if fp16 gradients overflowed.
+        """
+        with self.profiler.phase('optimizer'):
+            self._optimizer_step()
+        if self.grad_stats is not None:
+            # the scaler has unscaled the gradients in the step
+            self.grad_stats.update()
+
+    def _optimizer_step(self) -> None:
+        if self.compile and not self.scaler.is_enabled():
+            if self.compiled_opt is not self.opt:
+                # the optimizer is rebuilt by some methods (e.g. pnn) at task end
+                self.compiled_opt = self.opt
+                self.compiled_opt_step = torch.compile(self.opt.step)
+            self.compiled_opt_step()
+            return
+        self.scaler.step(self.opt)
+        self.scaler.update()
+
+    def update_frozen_params(self) -> None:
+        """
+        Drops the parameters that do not require grad (frozen by LP-FT) from
+        the param groups of the optimizer, with their state, and puts back
+        those that require it again. The backbone then skips its frozen
+        prefix in the forward and backward passes.
+        """
+        if self.opt_params is None or self.opt_params[0] is not self.opt:
+            # the optimizer is rebuilt by some methods (e.g. pnn) at task end
+            self.opt_params = (self.opt, [list(group['params']) for group in self.opt.param_groups], {})
+        _, all_params, dropped_state = self.opt_params
+        for group, params in zip(self.opt.param_groups, all_params):
+            group['params'] = [p for p in params if p.requires_grad]
+            for p in params:
+                if p.requires_grad and p in dropped_state:
+                    self.opt.state[p] = dropped_state.pop(p)
+                elif not p.requires_grad:
+                    # zero_grad no longer reaches it: drop the gradient of its last step
+                    p.grad = None
+                    if p in self.opt.state:
+                        dropped_state[p] = self.opt.state.pop(p)
+        backbone = self.net.module.backbone
+        if hasattr(backbone, 'update_frozen_prefix'):
+            backbone.update_frozen_prefix()
+
+    def method_state(self) -> dict:
+        """
+        State of the method outside self.net and self.opt, for the trial
+        checkpoints of main: the tensors and counters of the rehearsal buffer,
+        and the parameters frozen by LP-FT with the optimizer state dropped
+        with them (see update_frozen_params). Methods keeping more state
+        extend it, and load_method_state.
+        """
+        state = {'frozen': [name for name, p in self.net.named_parameters() if not p.requires_grad],
+                 'dropped_opt_state': [], 'buffer': None}
+        if self.opt_params is not None and self.opt_params[0] is self.opt:
+            _, all_params, dropped_state = self.opt_params
+            # keyed by the position of the parameter in the param groups
+            state['dropped_opt_state'] = [(g, i, dropped_state[p]) for g, params in enumerate(all_params)
+                                          for i, p in enumerate(params) if p in dropped_state]
+        buffer = getattr(self, 'buffer', None)
+        if isinstance(buffer, Buffer):
+            state['buffer'] = {k: v for k, v in vars(buffer).items() if isinstance(v, (torch.Tensor, int))}
+        return state
+
+    def load_method_state(self, state: dict) -> None:
+        """
+        Restores a method_state, loaded on the cpu. Must precede the loading
+        of the optimizer state, whose param groups leave out frozen parameters.
+        """
+        frozen = set(state['frozen'])
+        for name, p in self.net.named_parameters():
+            p.requires_grad_(name not in frozen)
+        self.update_frozen_params()
+        _, all_params, dropped_state = self.opt_params
+        for g, i, param_state in state['dropped_opt_state']:
+            p = all_params[g][i]
+            dropped_state[p] = {k: to_device(v, p.device) for k, v in param_state.items()}
+        if state['buffer'] is not None:
+            vars(self.buffer).update({k: to_device(v, self.buffer.device) for k, v in state['buffer'].items()})
+
+    def ssl_forward(self, x1: torch.Tensor, x2: torch.Tensor) -> dict:
+        """
+        Two-view forward of the SSL network (loss included). With train.compile
+        the forward, and through it the backward, run as a compiled graph
+        captured for the shape of the first batch; batches of any other shape
+        (the last, smaller batch of an epoch) fall back to eager mode instead
+        of triggering a recompilation.
+        """
+        if self.compile:
+            if self.compiled_net is None:
+                mode = 'reduce-overhead' if self.device.type == 'cuda' else 'default'
+                self.compiled_net = torch.compile(self.net, mode=mode, dynamic=False)
+                self.compiled_shape = x1.shape
+            if x1.shape == self.compiled_shape:
+                return self.compiled_net(x1, x2)
+        return self.net.forward(x1, x2)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """
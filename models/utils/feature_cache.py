@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import torch
+
+
+class FeatureCache:
+    """
+    Backbone features of the training samples of a task, for the linear
+    probing epochs of LP-FT. While the whole backbone is frozen its features
+    only change with the augmentation: draws augmented passes over the task
+    are run through it once, and the probing epochs cycle over them, training
+    the head (or the projector and predictor) alone.
+
+    The features, [draws, samples, views, dim], are kept on the device, or in
+    a .npy memmap at path.
+    """
+    def __init__(self, n_samples: int, n_views: int, dim: int, draws: int, device, path: str=None) -> None:
+        shape = (draws, n_samples, n_views, dim)
+        self.path = path
+        if path is None:
+            self.features = torch.empty(shape, device=device)
+        else:
+            self.features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+        self.labels = torch.empty(draws, n_samples, dtype=torch.long, device=device)
+        self.device = device
+        self.sizes = [0] * draws
+
+    @torch.no_grad()
+    def add(self, draw: int, features: torch.Tensor, labels: torch.Tensor) -> None:
+        """
+        Appends a batch of features ([N, views, dim]) to the samples of draw.
+        """
+        start, end = self.sizes[draw], self.sizes[draw] + len(labels)
+        if self.path is None:
+            self.features[draw, start:end] = features
+        else:
+            self.features[draw, start:end] = features.float().cpu().numpy()
+        self.labels[draw, start:end] = labels
+        self.sizes[draw] = end
+
+    def batches(self, epoch: int, batch_size: int, drop_last: bool=True):
+        """
+        Iterates the samples of draw epoch % draws in a random order.
+        :return: (features of every view, labels) batches, on the device
+        """
+        draw = epoch % len(self.sizes)
+        for idx in torch.randperm(self.sizes[draw]).split(batch_size):
+            if drop_last and len(idx) < batch_size:
+                return
+            if self.path is None:
+                features = self.features[draw, idx.to(self.device)]
+            else:
+                # sorted reads are sequential in the file, the batch is shuffled anyway
+                idx = idx.sort().values
+                features = torch.from_numpy(self.features[draw, idx.numpy()]).to(self.device, non_blocking=True)
+            yield features.unbind(1), self.labels[draw, idx.to(self.device)]
+
+    def close(self) -> None:
+        """
+        Frees the features, deleting the memmap.
+        """
+        self.features = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
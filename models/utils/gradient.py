@@ -1,4 +1,4 @@
-
+import torch
 
 
 def norm(param,p=None):
@@ -6,25 +6,111 @@ def norm(param,p=None):
         param[1].grad.abs().mean() if param[1].grad != None else 0.
     return param[1].grad.norm(p=p) if param[1].grad != None else 0.
 
-def model_param_filter(model_params, thresh=0., inclusive=False):
+def model_param_filter(model_params, thresh=0., inclusive=False, norms=None):
     """
     filter to only params with 'norm' below threshold
     if thresh is negative (e.g. -0.1), threshold is bottom -thresh (e.g. 10) percentile value of the norms
+    norms: precomputed norms of model_params (e.g. GradStatsCollector.collect), computed here if None
     """
     lis = []
+    if norms is None:
+        norms = [norm(y) for y in model_params]
     if thresh == -1.:
         # freeze every param
-        return model_param_filter(model_params, float("inf"))
+        return model_param_filter(model_params, float("inf"), norms=norms)
     if thresh < 0.:
-        norms = [norm(y) for y in model_params]
         assert int(-thresh * len(norms)) > 0, "-thresh too small!"
         new_thresh = sorted(norms)[:int(-thresh * len(norms))][-1]
-        return model_param_filter(model_params, new_thresh, True)
+        return model_param_filter(model_params, new_thresh, True, norms=norms)
         
-    for y in model_params:
-        freeze = norm(y) <= thresh if inclusive else norm(y) < thresh
+    for y, n in zip(model_params, norms):
+        freeze = n <= thresh if inclusive else n < thresh
         if freeze:
-            lis.append((norm(y), y))
+            lis.append((n, y))
     
     return lis
 
+
+def grad_norms(grads):
+    """
+    L2 and L1 norms of every gradient of grads, with fused foreach kernels
+    where torch has them, one kernel per gradient otherwise (torch 1.9).
+    """
+    if hasattr(torch, '_foreach_norm'):
+        return torch._foreach_norm(grads), torch._foreach_norm(grads, 1)
+    return [g.norm() for g in grads], [g.abs().sum() for g in grads]
+
+
+class GradStatsCollector:
+    """
+    Gradient L2 norm and mean absolute value of named parameters, per
+    parameter and per layer, accumulated over steps on the device: update
+    runs (fused, see grad_norms) norms over the gradients and never syncs,
+    collect reads everything back to the cpu in a single copy. Parameters
+    without a gradient count as 0.
+    """
+    def __init__(self, named_params, layer_name) -> None:
+        """
+        :param named_params: list of (name, param)
+        :param layer_name: maps a (name, param) to the name of its layer
+        """
+        self.named_params = list(named_params)
+        self.layers = list(dict.fromkeys(layer_name(x) for x in self.named_params))
+        device = self.named_params[0][1].device if self.named_params else 'cpu'
+        self.layer_index = torch.tensor([self.layers.index(layer_name(x)) for x in self.named_params], device=device)
+        self.layer_sizes = torch.bincount(self.layer_index, minlength=len(self.layers)).clamp(min=1)
+        self.numels = torch.tensor([p.numel() for _, p in self.named_params], device=device, dtype=torch.float)
+        # positions of the parameters with a gradient, as a device tensor, for the last pattern seen
+        self.grad_index = (None, None)
+        self.reset()
+
+    def covers(self, named_params) -> bool:
+        """
+        Whether the collector tracks exactly the parameters of named_params.
+        """
+        return len(named_params) == len(self.named_params) and \
+            all(p is q for (_, p), (_, q) in zip(self.named_params, named_params))
+
+    def reset(self) -> None:
+        self.norms = torch.zeros_like(self.numels)
+        self.abs_means = torch.zeros_like(self.numels)
+        self.steps = 0
+
+    @torch.no_grad()
+    def update(self) -> None:
+        """
+        Adds the statistics of the current gradients.
+        """
+        self.steps += 1
+        with_grad = [i for i, (_, p) in enumerate(self.named_params) if p.grad is not None]
+        if not with_grad:
+            return
+        if self.grad_index[0] != with_grad:
+            self.grad_index = (with_grad, torch.tensor(with_grad, device=self.norms.device))
+        index = self.grad_index[1]
+        l2, l1 = grad_norms([self.named_params[i][1].grad for i in with_grad])
+        self.norms.index_add_(0, index, torch.stack(l2).float().to(self.norms.device))
+        self.abs_means.index_add_(0, index, torch.stack(l1).float().to(self.norms.device) / self.numels[index])
+
+    def collect(self, reset: bool=True) -> dict:
+        """
+        :return: the statistics averaged over the steps since the last reset:
+                 'norm' and 'abs_mean' of every parameter (lists, in the order
+                 of named_params), 'layer_norm' and 'layer_abs_mean' (dicts
+                 from layer name to the mean over its parameters)
+        """
+        steps = max(self.steps, 1)
+        layer_norms = torch.zeros(len(self.layers), device=self.norms.device).index_add_(0, self.layer_index, self.norms)
+        layer_abs_means = torch.zeros(len(self.layers), device=self.norms.device).index_add_(0, self.layer_index, self.abs_means)
+        stats = torch.cat([self.norms, self.abs_means, layer_norms / self.layer_sizes,
+                           layer_abs_means / self.layer_sizes]).div_(steps).tolist()
+        n, l = len(self.named_params), len(self.layers)
+        if reset:
+            self.reset()
+        return {
+            'norm': stats[:n],
+            'abs_mean': stats[n:2 * n],
+            'layer_norm': dict(zip(self.layers, stats[2 * n:2 * n + l])),
+            'layer_abs_mean': dict(zip(self.layers, stats[2 * n + l:])),
+        }
+
@@ -0,0 +1,39 @@
+import torch
+import torch.nn as nn
+
+
+class HeadBank(nn.Module):
+    """
+    The linear heads of the tasks, one [C, D] slice per task in a single
+    preallocated [T, C, D] weight (and [T, C] bias). Storing a head copies it
+    into its slot in place, so the bank takes the same memory whether it is
+    refreshed once per task or every epoch.
+    """
+    def __init__(self, n_tasks: int, n_classes: int, dim: int, device=None) -> None:
+        super().__init__()
+        self.register_buffer('weight', torch.zeros(n_tasks, n_classes, dim, device=device))
+        self.register_buffer('bias', torch.zeros(n_tasks, n_classes, device=device))
+
+    @classmethod
+    def from_heads(cls, heads: list) -> 'HeadBank':
+        bank = cls(len(heads), heads[0].out_features, heads[0].in_features, heads[0].weight.device)
+        for task, head in enumerate(heads):
+            bank.store(task, head)
+        return bank
+
+    @torch.no_grad()
+    def store(self, task, head: nn.Linear) -> None:
+        """
+        Copies head into the slot of task (an index or a slice of tasks).
+        """
+        self.weight[task] = head.weight
+        if head.bias is not None:
+            self.bias[task] = head.bias
+
+    def forward(self, features: torch.Tensor, n_tasks: int=None) -> torch.Tensor:
+        """
+        Applies the heads of the first n_tasks tasks (all by default) to features.
+        :return: the logits, [N, n_tasks, C]
+        """
+        weight, bias = self.weight[:n_tasks], self.bias[:n_tasks]
+        return torch.einsum('nd,tcd->ntc', features, weight) + bias
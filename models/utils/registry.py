@@ -0,0 +1,56 @@
+import torch
+from functools import lru_cache
+
+# continual learning methods, keyed by their NAME
+MODELS = {}
+# backbone factories, keyed by the name used in the config (model.backbone)
+BACKBONES = {}
+
+
+def register_model(cls):
+    """
+    Class decorator that makes a ContinualModel subclass selectable
+    through args.model.cl_model.
+    """
+    assert cls.NAME is not None, f"{cls.__name__} needs a NAME to be registered"
+    assert cls.NAME not in MODELS, f"model {cls.NAME} registered twice"
+    MODELS[cls.NAME] = cls
+    return cls
+
+
+def register_backbone(name=None):
+    """
+    Function decorator that makes a backbone factory selectable
+    through args.model.backbone. The factory is only called when
+    the backbone is actually requested.
+    """
+    def wrapper(factory):
+        key = name or factory.__name__
+        assert key not in BACKBONES, f"backbone {key} registered twice"
+        BACKBONES[key] = factory
+        return factory
+    return wrapper
+
+
+def get_all_models():
+    return sorted(MODELS)
+
+
+def get_all_backbones():
+    return sorted(BACKBONES)
+
+
+@lru_cache(maxsize=None)
+def backbone_num_params(name):
+    """
+    Number of parameters of a registered backbone, computed from the
+    parameter shapes only. When the meta device is available the backbone
+    is built there, so no weights are allocated or initialized.
+    """
+    factory = BACKBONES[name]
+    if hasattr(torch, 'get_default_device'):
+        with torch.device('meta'):
+            backbone = factory()
+    else:
+        backbone = factory()
+    return sum(p.numel() for p in backbone.parameters())
@@ -0,0 +1,106 @@
+"""
+Throughput of the augmentation pipelines on synthetic images: images per
+second of a DataLoader with 0..N workers (0 is the main process) and per
+worker, for the two-view SimSiam training transform, the classifier and eval
+transforms and the buffer transforms of the datasets. With --gpu, also the
+uint8 loading + on-device SimSiam augmentation path.
+
+    python -m tools.aug_throughput --image_sizes 32 64 --workers 0 1 2 4 8
+"""
+import argparse
+import time
+from argparse import Namespace
+import torch
+import torchvision.transforms as T
+from torch.utils.data import DataLoader
+from augmentations import get_aug, get_gpu_aug, Transform_single
+from datasets.random_dataset import RandomDataset
+from datasets.seq_cifar10 import SequentialCIFAR10
+from datasets.seq_tinyimagenet import SequentialTinyImagenet
+
+# dataset whose buffer transform (get_transform) is used at each image size
+BUFFER_DATASETS = {32: SequentialCIFAR10, 64: SequentialTinyImagenet}
+
+
+def pipelines(image_size, cl_default):
+    aug_kwargs = {'name': 'simsiam', 'image_size': image_size, 'cl_default': cl_default, 'scale': 0.2}
+    transforms = {
+        'simsiam': get_aug(train=True, **aug_kwargs),
+        'classifier': Transform_single(image_size, train=True),
+        'eval': Transform_single(image_size, train=False),
+    }
+    if image_size in BUFFER_DATASETS:
+        # the buffers transform stored CHW tensors, get_transform does not use the dataset state
+        dataset_cls = BUFFER_DATASETS[image_size]
+        buffer_transform = dataset_cls.get_transform(dataset_cls.__new__(dataset_cls), Namespace(cl_default=cl_default))
+        transforms['buffer'] = T.Compose([T.ToTensor(), buffer_transform])
+    return transforms
+
+
+def throughput(dataset, batch_size, num_workers, batches, warmup, on_batch=None):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        persistent_workers=num_workers > 0, drop_last=True)
+    images = 0
+    for epoch in range(2):
+        for idx, (x, _) in enumerate(loader):
+            if on_batch is not None:
+                on_batch(x)
+            if epoch == 0 and idx + 1 == warmup:
+                break
+            if epoch == 1 and idx == 0:
+                tic = time.perf_counter()
+            elif epoch == 1:
+                images += batch_size
+            if epoch == 1 and idx == batches:
+                break
+    return images / (time.perf_counter() - tic)
+
+
+def report(name, image_size, num_workers, images_per_sec):
+    per_worker = images_per_sec / max(num_workers, 1)
+    print(f"{name:>12} {image_size:>5} {num_workers:>8} {images_per_sec:>10.0f} {per_worker:>11.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--pipelines', nargs='+', default=['simsiam', 'classifier', 'eval', 'buffer'])
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--cl_default', action='store_true')
+    parser.add_argument('--gpu', action='store_true', help='also time uint8 loading + on-device augmentation')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    size = args.batch_size * (args.batches + args.warmup + 2)
+
+    print(f"{'pipeline':>12} {'size':>5} {'workers':>8} {'img/s':>10} {'img/s/wkr':>11}")
+    for image_size in args.image_sizes:
+        transforms = pipelines(image_size, args.cl_default)
+        for name in args.pipelines:
+            if name not in transforms:
+                continue
+            dataset = RandomDataset(transform=transforms[name], image_size=image_size, size=size)
+            for num_workers in args.workers:
+                report(name, image_size, num_workers,
+                       throughput(dataset, args.batch_size, num_workers, args.batches, args.warmup))
+
+        if args.gpu:
+            aug_kwargs = {'name': 'simsiam', 'image_size': image_size, 'cl_default': args.cl_default, 'scale': 0.2, 'gpu': True}
+            gpu_aug = get_gpu_aug(**aug_kwargs)
+            device = torch.device(args.device)
+
+            def on_batch(x):
+                gpu_aug(x.to(device, non_blocking=True))
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+
+            dataset = RandomDataset(transform=get_aug(train=True, **aug_kwargs), image_size=image_size, size=size)
+            for num_workers in args.workers:
+                report(f'simsiam-{device.type}', image_size, num_workers,
+                       throughput(dataset, args.batch_size, num_workers, args.batches, args.warmup, on_batch))
+
+
+if __name__ == "__main__":
+    main()
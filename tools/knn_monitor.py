@@ -24,9 +24,9 @@ def knn_monitor(net, dataset, memory_data_loader, test_data_loader, device, cl_d
         # generate feature bank        
         for data, target, *meta_args in tqdm(memory_data_loader, desc='Feature extracting', leave=False, disable=False):
             if cl_default:
-                feature = net(data.cuda(non_blocking=True), return_features=True)
+                feature = net(data.to(device, non_blocking=True), return_features=True)
             else:
-                feature = net(data.cuda(non_blocking=True))
+                feature = net(data.to(device, non_blocking=True))
             feature_norm = torch.empty_like(feature)
             F.normalize(feature, dim=1, out=feature_norm)
             feature_norm = feature_norm.detach().cpu()
@@ -42,7 +42,7 @@ def knn_monitor(net, dataset, memory_data_loader, test_data_loader, device, cl_d
         # loop test data to predict the label by weighted knn search
         test_bar = tqdm(test_data_loader, desc='kNN', disable=False)
         for data, target, *meta_args in test_bar:
-            data = data.cuda(non_blocking=True)
+            data = data.to(device, non_blocking=True)
             if cl_default:
                 feature = net(data, return_features=True)
             else:
@@ -121,9 +121,9 @@ def logistic_monitor(net, dataset, memory_data_loader, test_data_loader, device,
     target_set = set()
     for (data, target, *meta_args) in tqdm(memory_data_loader, desc='Feature extracting', leave=False, disable=False):        
         if cl_default:
-            feature = net(data.cuda(non_blocking=True), return_features=True)
+            feature = net(data.to(device, non_blocking=True), return_features=True)
         else:
-            feature = net(data.cuda(non_blocking=True))
+            feature = net(data.to(device, non_blocking=True))
         feature = feature.detach()
         features.append(feature)
         targets.append(target)
@@ -140,9 +140,9 @@ def logistic_monitor(net, dataset, memory_data_loader, test_data_loader, device,
     targets = []
     for (data, target, *meta_args) in tqdm(test_data_loader, desc='Feature extracting', leave=False, disable=False):        
         if cl_default:
-            feature = net(data.cuda(non_blocking=True), return_features=True)
+            feature = net(data.to(device, non_blocking=True), return_features=True)
         else:
-            feature = net(data.cuda(non_blocking=True))
+            feature = net(data.to(device, non_blocking=True))
         feature = feature.detach()
         features.append(feature)
         targets.append(target)
@@ -0,0 +1,73 @@
+"""
+Latency of one SSL training step (two-view forward, loss, backward, SGD
+update) in eager mode and with torch.compile, for the CIFAR resnet18.
+
+    python -m tools.step_latency --model simsiam --batch_size 256
+"""
+import argparse
+import time
+import torch
+from models import get_backbone
+from models.simsiam import SimSiam
+from models.barlowtwins import BarlowTwins
+
+
+def build(model, device):
+    backbone = get_backbone('resnet18', 'seq-cifar10', castrate=False)
+    if model == 'simsiam':
+        net = SimSiam(backbone)
+    else:
+        net = BarlowTwins(backbone, device)
+    net.projector.set_layers(2)
+    net = net.to(device)
+    opt = torch.optim.SGD(net.parameters(), lr=0.03, momentum=0.9, weight_decay=5e-4)
+    return net, opt
+
+
+def measure(forward, opt_step, opt, x1, x2, device, warmup, iters):
+    def step():
+        opt.zero_grad()
+        forward(x1, x2)['loss'].backward()
+        opt_step()
+
+    for _ in range(warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    tic = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - tic) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='simsiam', choices=['simsiam', 'barlowtwins'])
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    x1 = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    x2 = torch.randn_like(x1)
+
+    torch.manual_seed(0)
+    net, opt = build(args.model, device)
+    eager = measure(net, opt.step, opt, x1, x2, device, args.warmup, args.iters)
+    print(f"eager:    {eager:.2f} ms/step")
+
+    torch.manual_seed(0)
+    net, opt = build(args.model, device)
+    mode = 'reduce-overhead' if device.type == 'cuda' else 'default'
+    compiled_net = torch.compile(net, mode=mode, dynamic=False)
+    compiled = measure(compiled_net, torch.compile(opt.step), opt, x1, x2, device, args.warmup, args.iters)
+    print(f"compiled: {compiled:.2f} ms/step ({eager / compiled:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
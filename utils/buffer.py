@@ -7,6 +7,8 @@ import torch
 import numpy as np
 from typing import Tuple
 from torchvision import transforms
+import torch.distributed as dist
+from utils.distributed import is_distributed, get_rank, get_world_size, collective_device
 
 
 def reservoir(num_seen_examples: int, buffer_size: int) -> int:
@@ -75,8 +77,7 @@ class Buffer:
             self.init_tensors(examples, labels, logits, task_labels)
 
         for i in range(examples.shape[0]):
-            index = reservoir(self.num_seen_examples, self.buffer_size)
-            self.num_seen_examples += 1
+            index = self.next_index()
             if index >= 0:
                 self.examples[index] = examples[i].to(self.device)
                 if labels is not None:
@@ -86,6 +87,21 @@ class Buffer:
                 if task_labels is not None:
                     self.task_labels[index] = task_labels[i].to(self.device)
 
+    def next_index(self) -> int:
+        """
+        Counts a new example as seen.
+        :return: the slot where it is stored, -1 if it is discarded
+        """
+        index = reservoir(self.num_seen_examples, self.buffer_size)
+        self.num_seen_examples += 1
+        return index
+
+    def num_stored(self) -> int:
+        """
+        Returns the number of filled slots.
+        """
+        return min(self.num_seen_examples, self.examples.shape[0])
+
     def get_data(self, size: int, transform: transforms=None) -> Tuple:
         """
         Random samples a batch of size items.
@@ -93,11 +109,10 @@ class Buffer:
         :param transform: the transformation to be applied (data augmentation)
         :return:
         """
-        if size > min(self.num_seen_examples, self.examples.shape[0]):
-            size = min(self.num_seen_examples, self.examples.shape[0])
+        if size > self.num_stored():
+            size = self.num_stored()
 
-        choice = np.random.choice(min(self.num_seen_examples, self.examples.shape[0]),
-                                  size=size, replace=False)
+        choice = np.random.choice(self.num_stored(), size=size, replace=False)
         if transform is None: transform = lambda x: x
         # import pdb
         # pdb.set_trace()
@@ -142,3 +157,71 @@ class Buffer:
             if hasattr(self, attr_str):
                 delattr(self, attr_str)
         self.num_seen_examples = 0
+
+
+class DistributedBuffer(Buffer):
+    """
+    The memory buffer of a distributed run. Every process owns buffer_size
+    slots, holding its own examples only, so the capacity grows with the
+    number of processes. The reservoir runs over the stream of all the
+    processes: the number of examples each one adds is all-reduced at every
+    add_data, and the example at global position p is kept with probability
+    capacity / (p + 1), in a random slot of its own process.
+
+    get_data samples the local slots only. As the training shards have the
+    same size, every process holds a uniform sample of its stream, and the
+    draws of all the processes, whose gradients are averaged, are a
+    (stratified) uniform sample of the whole buffer.
+    """
+    def __init__(self, buffer_size, device, n_tasks=None, mode='reservoir'):
+        assert mode == 'reservoir', "the distributed buffer only supports reservoir sampling"
+        super(DistributedBuffer, self).__init__(buffer_size, device, n_tasks, mode)
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.capacity = buffer_size * self.world_size
+        self.num_local_examples = 0
+        self.position = 0
+        # the processes must not take the same reservoir decisions
+        self.rng = np.random.RandomState(np.random.randint(2 ** 31 - self.world_size) + self.rank)
+
+    def add_data(self, examples, labels=None, logits=None, task_labels=None):
+        """
+        Adds the data to the shard of the process. Must be called by all the
+        processes at the same time.
+        """
+        counts = torch.zeros(self.world_size, dtype=torch.long, device=collective_device())
+        counts[self.rank] = examples.shape[0]
+        dist.all_reduce(counts)
+        counts = counts.tolist()
+        # the examples of the lower ranks come first in the global stream
+        self.position = self.num_seen_examples + sum(counts[:self.rank])
+        super(DistributedBuffer, self).add_data(examples, labels, logits, task_labels)
+        self.num_seen_examples += sum(counts)
+
+    def next_index(self) -> int:
+        if self.num_local_examples < self.buffer_size:
+            index = self.num_local_examples
+        elif self.rng.randint(0, self.position + 1) < self.capacity:
+            index = self.rng.randint(0, self.buffer_size)
+        else:
+            index = -1
+        self.num_local_examples += 1
+        self.position += 1
+        return index
+
+    def num_stored(self) -> int:
+        return min(self.num_local_examples, self.examples.shape[0])
+
+    def empty(self) -> None:
+        super(DistributedBuffer, self).empty()
+        self.num_local_examples = 0
+
+
+def get_buffer(buffer_size, device, n_tasks=None, mode='reservoir') -> Buffer:
+    """
+    Returns the memory buffer of the process: a DistributedBuffer, sharded
+    across the processes, in a distributed run.
+    """
+    if is_distributed():
+        return DistributedBuffer(buffer_size, device, n_tasks, mode)
+    return Buffer(buffer_size, device, n_tasks, mode)
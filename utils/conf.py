@@ -3,15 +3,17 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import random
 import torch
 import numpy as np
 
 def get_device() -> torch.device:
     """
-    Returns the GPU device if available else CPU.
+    Returns the GPU device if available else CPU. In a torchrun launch,
+    the GPU of the process (LOCAL_RANK).
     """
-    return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    return torch.device(f"cuda:{os.environ.get('LOCAL_RANK', 0)}" if torch.cuda.is_available() else "cpu")
 
 
 def base_path() -> str:
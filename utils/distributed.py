@@ -0,0 +1,103 @@
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """
+    Whether this process logs and writes checkpoints (rank 0, or the only process).
+    """
+    return get_rank() == 0
+
+
+def collective_device() -> torch.device:
+    """
+    Device of the tensors exchanged by collectives: the gpu of the process
+    with nccl, the cpu with gloo.
+    """
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def barrier() -> None:
+    """
+    Waits for every process of a distributed run, no-op otherwise.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(args) -> bool:
+    """
+    Joins the process group of a torchrun launch (WORLD_SIZE > 1): nccl with
+    one gpu per process (the one of LOCAL_RANK) on cuda, gloo on cpu.
+    args.device is set to the device of the process.
+    :return: whether the run is distributed
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    cuda = torch.device(args.device).type == 'cuda'
+    if cuda:
+        torch.cuda.set_device(local_rank)
+        args.device = f'cuda:{local_rank}'
+    if not is_distributed():
+        dist.init_process_group('nccl' if cuda else 'gloo')
+    return True
+
+
+def cleanup_distributed() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class LocalModule(nn.Module):
+    """
+    Single process counterpart of DistributedDataParallel: the network is
+    reached as .module and its parameters are named module.* in both modes.
+    """
+    def __init__(self, module: nn.Module) -> None:
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+
+def wrap_net(net: nn.Module, device, find_unused_parameters: bool=False) -> nn.Module:
+    """
+    Wraps net in DistributedDataParallel in a distributed run, in a LocalModule
+    otherwise. Only the forward passes made through the wrapper synchronize
+    their gradients: a training step must go through it exactly once before
+    each backward, other forward passes of the step use .module.
+    """
+    if not is_distributed():
+        return LocalModule(net)
+    device = torch.device(device)
+    return DistributedDataParallel(net, device_ids=[device] if device.type == 'cuda' else None,
+                                   find_unused_parameters=find_unused_parameters)
+
+
+def convert_sync_bn(net: nn.Module) -> None:
+    """
+    Replaces, in place, the BatchNorm layers of the projector and predictor of
+    a SimSiam/BarlowTwins net by SyncBatchNorm, which computes the statistics
+    over the batches of all the processes.
+    """
+    for name in ['projector', 'predictor']:
+        setattr(net, name, nn.SyncBatchNorm.convert_sync_batchnorm(getattr(net, name)))
@@ -0,0 +1,138 @@
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+
+
+class NullProfiler:
+    """
+    Profiler of models that are not profiled: every phase is a no-op.
+    """
+    def phase(self, name: str):
+        return nullcontext()
+
+    def iterate(self, loader):
+        return loader
+
+    def step(self) -> None:
+        pass
+
+    def end_epoch(self, task: int, epoch: int) -> dict:
+        pass
+
+
+class StepProfiler(NullProfiler):
+    """
+    Wall time of the phases of training (data wait, host to device copies,
+    forward, backward, optimizer, buffer, gradient surgery, monitors...), per
+    epoch, with the peak memory of the epoch. Phases nest and their times are
+    exclusive: the time of an inner phase is not counted in the outer one, so
+    the phases of an epoch add up to the time it was profiled.
+
+    The report is rewritten to <log_dir>/profile.json at the end of every
+    epoch. trace_window=(start, steps) additionally records a torch.profiler
+    trace of training steps [start, start + steps) to <log_dir>/trace.json.
+    """
+    def __init__(self, log_dir: str, name: str=None, device: torch.device=None,
+                 synchronize: bool=True, trace_window=None) -> None:
+        self.log_dir = log_dir
+        self.name = name
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        # without synchronizing, asynchronous cuda kernels are charged to whichever phase waits for them
+        self.synchronize = synchronize and self.cuda
+        self.trace_window = trace_window
+        self.trace = None
+        self.steps = 0
+        self.epochs = []
+        self.start_epoch()
+
+    def start_epoch(self) -> None:
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stack = []
+        self.epoch_steps = 0
+        self.epoch_start = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        now = self._now()
+        if self.stack:
+            outer, start = self.stack[-1]
+            self.times[outer] += now - start
+        self.stack.append((name, now))
+        try:
+            yield
+        finally:
+            now = self._now()
+            name, start = self.stack.pop()
+            self.times[name] += now - start
+            self.calls[name] += 1
+            if self.stack:
+                self.stack[-1] = (self.stack[-1][0], now)
+
+    def iterate(self, loader):
+        """
+        Iterates loader, charging the wait for each batch to the 'data' phase.
+        """
+        iterator = iter(loader)
+        while True:
+            with self.phase('data'):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self) -> None:
+        """
+        Marks the end of a training step.
+        """
+        self.steps += 1
+        self.epoch_steps += 1
+        if self.trace_window is None:
+            return
+        start, steps = self.trace_window
+        if self.steps == start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, profile_memory=True)
+            self.trace.start()
+        elif self.steps == start + steps and self.trace is not None:
+            self.trace.stop()
+            self.trace.export_chrome_trace(os.path.join(self.log_dir, 'trace.json'))
+            self.trace = None
+
+    def end_epoch(self, task: int, epoch: int) -> dict:
+        """
+        Closes the breakdown of the epoch and rewrites the report.
+        """
+        total = time.perf_counter() - self.epoch_start
+        breakdown = {
+            'task': task,
+            'epoch': epoch,
+            'seconds': total,
+            'steps': self.epoch_steps,
+            'phases': {name: {'seconds': seconds, 'calls': self.calls[name], 'fraction': seconds / total}
+                       for name, seconds in sorted(self.times.items(), key=lambda item: -item[1])},
+            'unaccounted_seconds': total - sum(self.times.values()),
+            # linux reports the peak resident set size in kilobytes
+            'peak_host_memory_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+        if self.cuda:
+            breakdown['peak_cuda_memory_bytes'] = torch.cuda.max_memory_allocated()
+        self.epochs.append(breakdown)
+        with open(os.path.join(self.log_dir, 'profile.json'), 'w') as f:
+            json.dump({'name': self.name, 'epochs': self.epochs}, f, indent=2)
+        self.start_epoch()
+        return breakdown